@@ -1,7 +1,23 @@
+import array
+import bisect
+import collections
+import csv
+import functools
+import itertools
+import operator
 import os
 import pickle
 import tempfile
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+# A journal is compacted once its tail holds more transactions than
+# both this and the snapshot before it, so compaction stays amortised O(1)
+JOURNAL_MIN_TAIL = 1000
+
+# The date index of a columnar account keeps exact running totals only
+# every this many transactions and adds up the rest on demand
+CHECKPOINT_INTERVAL = 64
 
 
 class AccountError(Exception):
@@ -20,17 +36,37 @@ class LoadError(AccountError):
     pass
 
 
+class NoRateError(AccountError):
+    pass
+
+
 class Account:
     """Account store info about account number, name and list of Transactions
+
+    With columnar=True the transactions are kept in a TransactionBatch,
+    which needs far less memory than a list of Transaction objects.
+
+    >>> acc = Account(42, 'columnar', columnar=True)
+    >>> acc.apply(Transaction(6250, datetime(2019, 5, 19), currency='RUB', usd_conversion_rate=62.5))
+    >>> acc.balance, acc.all_usd, len(acc)
+    (100.0, False, 1)
     """
 
-    def __init__(self, number, name):
+    # RateTable used by balance_in() unless one is passed in
+    rates = None
+
+    def __init__(self, number, name, columnar=False):
         if number is None:
             raise ValueError('number should be provided')
         self._verify_name(name)
         self._number = number
         self._name = name
-        self._transactions = []
+        self._transactions = TransactionBatch() if columnar else []
+        self._reset_summary()
+        self.filename = None
+        self._journal = None
+        self._snapshot_length = 0
+        self._tail_length = 0
 
     def _verify_name(self, name):
         if name is None:
@@ -71,11 +107,235 @@ class Account:
     def name(self, name):
         self._verify_name(name)
         self._name = name
+        if self._journal is not None:
+            self._append(name)
+
+    def _reset_summary(self):
+        # Running totals kept up to date by apply(), so balance and
+        # all_usd do not have to walk every transaction
+        self._balance = Decimal(0)
+        self._non_usd = 0
+        self._amounts = collections.defaultdict(Decimal)
+        self._dates = None
+        for t in self._transactions:
+            self._add_to_summary(t)
+
+    def _add_to_summary(self, transaction):
+        amount = Decimal(str(transaction.amount))
+        usd = amount / Decimal(str(transaction.usd_conversion_rate))
+        self._balance += usd
+        self._amounts[transaction.currency] += amount
+        if transaction.currency != 'USD':
+            self._non_usd += 1
+        if self._dates is not None:
+            self._extend_index([transaction], [transaction.currency],
+                               [amount], [usd])
+
+    def _extend_index(self, transactions, currencies, amounts, usd):
+        # Transactions usually arrive in date order and simply extend the
+        # index; anything earlier than the last one discards it. The
+        # transactions have already been added to self._transactions.
+        columnar = isinstance(self._transactions, TransactionBatch)
+        if columnar:
+            start = len(self._transactions) - len(transactions)
+            dates = self._transactions.dates[start:]
+        else:
+            dates = [t.date for t in transactions]
+        ordered = self._dates[-1:] + dates
+        if not all(a <= b for a, b in zip(ordered, ordered[1:])):
+            self._dates = None
+            return
+        if columnar:
+            self._order.extend(range(start, len(self._transactions)))
+            self._dates.extend(dates)
+            self._add_checkpoints()
+            return
+        for position, currency, amount in zip(
+                itertools.count(len(self._dates)), currencies, amounts):
+            self._index_amount(position, currency, amount)
+        self._dates.extend(dates)
+        self._by_date.extend(transactions)
+        self._totals.extend(itertools.islice(itertools.accumulate(
+            usd, initial=self._totals[-1]), 1, None))
+
+    def _date_index(self):
+        # Lazily built date-ordered view of the transactions: the dates
+        # (for bisection), the transactions in the same order, and running
+        # USD totals where _totals[i] is the sum of the first i of them
+        if self._dates is None:
+            if isinstance(self._transactions, TransactionBatch):
+                self._index_batch()
+                return self._dates
+            self._by_date = sorted(self._transactions, key=lambda t: t.date)
+            self._dates = [t.date for t in self._by_date]
+            amounts = list(map(Decimal, map(str, map(_AMOUNT,
+                                                      self._by_date))))
+            rates = map(Decimal, map(str, map(_RATE, self._by_date)))
+            self._totals = list(itertools.accumulate(
+                map(operator.truediv, amounts, rates), initial=Decimal(0)))
+            self._by_currency = {}
+            for position, (currency, amount) in enumerate(
+                    zip(map(_CURRENCY, self._by_date), amounts)):
+                self._index_amount(position, currency, amount)
+        return self._dates
+
+    def _index_amount(self, position, currency, amount):
+        # Per-currency running totals alongside the date index: the
+        # positions holding that currency, and totals[i], the amount in
+        # the first i of those positions
+        positions, totals = self._by_currency.setdefault(
+            currency, ([], [Decimal(0)]))
+        positions.append(position)
+        totals.append(totals[-1] + amount)
+
+    def _index_batch(self):
+        # The columnar date index: _order holds the positions of the
+        # transactions in date order and _dates their dates as stored in
+        # the batch; _checkpoints[k] is (USD total, {currency: amount}) of
+        # the first k * CHECKPOINT_INTERVAL of them
+        dates = self._transactions.dates
+        self._order = array.array('q', sorted(range(len(dates)),
+                                              key=dates.__getitem__))
+        self._dates = array.array('q', map(dates.__getitem__, self._order))
+        self._checkpoints = [(Decimal(0), {})]
+        self._add_checkpoints()
+
+    def _add_checkpoints(self):
+        while len(self._checkpoints) * CHECKPOINT_INTERVAL <= len(self._order):
+            usd, amounts = self._batch_totals(
+                len(self._checkpoints) * CHECKPOINT_INTERVAL)
+            self._checkpoints.append((usd, dict(amounts)))
+
+    def _batch_totals(self, end):
+        # (USD total, {currency: amount}) of the first end transactions in
+        # date order: the last checkpoint up to end plus the ones after it
+        checkpoint = min(end // CHECKPOINT_INTERVAL,
+                         len(self._checkpoints) - 1)
+        usd, amounts = self._checkpoints[checkpoint]
+        amounts = collections.defaultdict(Decimal, amounts)
+        batch = self._transactions
+        for position in self._order[checkpoint * CHECKPOINT_INTERVAL:end]:
+            amount = Decimal(str(batch.amounts[position]))
+            usd += amount / Decimal(str(batch.rates[position]))
+            amounts[batch.currencies[batch.codes[position]]] += amount
+        return usd, amounts
+
+    def _bisect(self, bisector, when):
+        # bisector (bisect_left or bisect_right) applied to the date index;
+        # a plain date stands for the end of that day with bisect_right
+        # and for its start with bisect_left
+        if not isinstance(when, datetime):
+            when = datetime.combine(when, datetime.max.time()
+                                    if bisector is bisect.bisect_right
+                                    else datetime.min.time())
+        dates = self._date_index()
+        if isinstance(self._transactions, TransactionBatch):
+            when = (when - _EPOCH) // _MICROSECOND
+        return bisector(dates, when)
+
+    def _usd_before(self, end):
+        # USD total of the first end transactions in date order
+        if isinstance(self._transactions, TransactionBatch):
+            return self._batch_totals(end)[0]
+        return self._totals[end]
+
+    def _amounts_before(self, end):
+        # {currency: amount} of the first end transactions in date order
+        if isinstance(self._transactions, TransactionBatch):
+            return self._batch_totals(end)[1]
+        return {each: totals[bisect.bisect_left(positions, end)]
+                for each, (positions, totals) in self._by_currency.items()}
 
     def apply(self, transaction):
         if transaction is None:
             raise ValueError('transaction should be provided')
         self._transactions.append(transaction)
+        self._add_to_summary(transaction)
+        if self._journal is not None:
+            self._append(transaction)
+
+    def apply_many(self, transactions):
+        """Apply a batch of transactions at once
+
+        The whole batch is validated before any of it is applied, and the
+        running totals, date index and journal are updated once per batch.
+
+        >>> timestamp = datetime(2019, 5, 19, 22, 20, 0)
+        >>> acc = Account(42, 'default')
+        >>> acc.apply_many([Transaction(100, timestamp),
+        ...                 Transaction(6250, timestamp, currency='RUB', usd_conversion_rate=62.5)])
+        >>> acc.balance, len(acc)
+        (200.0, 2)
+        >>> acc.apply_many([Transaction(100, timestamp), None])
+        Traceback (most recent call last):
+        ...
+        ValueError: transaction should be provided
+        >>> len(acc)
+        2
+
+        Columnar accounts also refuse the whole batch if any date is not
+        naive
+        >>> acc = Account(42, 'columnar', columnar=True)
+        >>> acc.apply(Transaction(100, timestamp))
+        >>> acc.apply_many([Transaction(100, timestamp),
+        ...                 Transaction(100, timestamp.astimezone())])
+        Traceback (most recent call last):
+        ...
+        ValueError: columnar storage needs naive dates
+        >>> len(acc), acc.balance
+        (1, 100.0)
+        """
+        transactions = list(transactions)
+        if any(t is None for t in transactions):
+            raise ValueError('transaction should be provided')
+        if not transactions:
+            return
+        if isinstance(self._transactions, TransactionBatch):
+            # Storing the batch first checks it the way the account's
+            # own batch would
+            stored = TransactionBatch(transactions)
+        else:
+            stored = transactions
+        # The same conversion as _add_to_summary(), but mapped over whole
+        # columns and converting each distinct rate only once
+        rates = list(map(_RATE, transactions))
+        decimal_rates = {rate: Decimal(str(rate)) for rate in set(rates)}
+        amounts = list(map(Decimal, map(str, map(_AMOUNT, transactions))))
+        usd = list(map(operator.truediv, amounts,
+                       map(decimal_rates.__getitem__, rates)))
+        currencies = list(map(_CURRENCY, transactions))
+        self._transactions.extend(stored)
+        self._balance += sum(usd, Decimal(0))
+        self._non_usd += len(currencies) - currencies.count('USD')
+        for currency, amount in zip(currencies, amounts):
+            self._amounts[currency] += amount
+        if self._dates is not None:
+            self._extend_index(transactions, currencies, amounts, usd)
+        if self._journal is not None:
+            self._append(*transactions)
+
+    def aggregate(self):
+        """Return (USD balance, {currency: total amount},
+        {day: USD total}) for all account transactions
+
+        Columnar accounts compute these in one vectorized NumPy pass when
+        NumPy is installed. Totals are floats, unlike the exact balance.
+
+        >>> acc = Account(42, 'default')
+        >>> acc.apply_many([Transaction(100, datetime(2019, 5, 19, 10)),
+        ...                 Transaction(50, datetime(2019, 5, 19, 12)),
+        ...                 Transaction(6250, datetime(2019, 5, 20), currency='RUB', usd_conversion_rate=62.5)])
+        >>> balance, by_currency, by_day = acc.aggregate()
+        >>> balance
+        250.0
+        >>> sorted(by_currency.items())
+        [('RUB', 6250.0), ('USD', 150.0)]
+        >>> sorted(by_day.items())
+        [(datetime.date(2019, 5, 19), 150.0), (datetime.date(2019, 5, 20), 100.0)]
+        """
+        if isinstance(self._transactions, TransactionBatch):
+            return self._transactions.aggregate()
+        return _aggregate(self._transactions)
 
     def __len__(self):
         return len(self._transactions)
@@ -93,11 +353,132 @@ class Account:
         >>> acc.apply(Transaction(6250, timestamp, currency='RUB', usd_conversion_rate=62.5))
         >>> acc.balance
         200.0
+
+        Amounts are accumulated as decimals, so many small transactions
+        do not drift
+        >>> acc = Account(42, 'default')
+        >>> for _ in range(10):
+        ...     acc.apply(Transaction(0.1, timestamp))
+        >>> acc.balance
+        1.0
         """
-        balance = 0
-        for t in self._transactions:
-            balance += t.usd
-        return balance
+        return float(self._balance)
+
+    def balance_at(self, date):
+        """Return balance in USD of the transactions made up to and
+        including date
+
+        >>> acc = Account(42, 'default')
+        >>> acc.apply(Transaction(100, datetime(2019, 5, 1)))
+        >>> acc.apply(Transaction(6250, datetime(2019, 3, 1), currency='RUB', usd_conversion_rate=62.5))
+        >>> acc.apply(Transaction(50, datetime(2019, 4, 1)))
+        >>> acc.balance_at(datetime(2019, 1, 1))
+        0.0
+        >>> acc.balance_at(datetime(2019, 4, 1))
+        150.0
+        >>> acc.balance_at(datetime(2020, 1, 1)) == acc.balance
+        True
+
+        A date includes all of that day
+        >>> acc.apply(Transaction(25, datetime(2019, 4, 1, 18, 30)))
+        >>> acc.balance_at(date(2019, 4, 1)), acc.balance_at(date(2019, 3, 31))
+        (175.0, 100.0)
+
+        Columnar accounts index transaction positions and keep exact
+        totals only every CHECKPOINT_INTERVAL transactions
+        >>> acc = Account(42, 'columnar', columnar=True)
+        >>> acc.apply_many(Transaction(1, datetime(2019, 1, 1) + timedelta(days=day)) for day in range(100, 0, -1))
+        >>> acc.apply(Transaction(6250, datetime(2019, 12, 31), currency='RUB', usd_conversion_rate=62.5))
+        >>> acc.balance_at(datetime(2019, 1, 1)), acc.balance_at(datetime(2019, 3, 12))
+        (0.0, 70.0)
+        >>> acc.balance_at(datetime(2020, 1, 1))
+        200.0
+        >>> acc.balance_at(date(2019, 3, 12)), acc.balance_at(date(2019, 12, 31))
+        (70.0, 200.0)
+        """
+        return float(self._usd_before(self._bisect(bisect.bisect_right,
+                                                    date)))
+
+    def transactions_between(self, start, end):
+        """Return the transactions with start <= date < end, in date order
+
+        >>> acc = Account(42, 'default')
+        >>> acc.apply(Transaction(100, datetime(2019, 5, 1)))
+        >>> acc.apply(Transaction(200, datetime(2019, 3, 31)))
+        >>> acc.apply(Transaction(300, datetime(2019, 3, 1)))
+        >>> [str(t) for t in acc.transactions_between(datetime(2019, 3, 1),
+        ...                                           datetime(2019, 4, 1))]
+        ['300 USD at 2019-03-01 00:00:00', '200 USD at 2019-03-31 00:00:00']
+
+        Dates stand for the start of their day
+        >>> acc.apply(Transaction(400, datetime(2019, 3, 31, 23, 59)))
+        >>> [str(t) for t in acc.transactions_between(date(2019, 3, 1),
+        ...                                           date(2019, 4, 1))]
+        ['300 USD at 2019-03-01 00:00:00', '200 USD at 2019-03-31 00:00:00', '400 USD at 2019-03-31 23:59:00']
+        >>> acc = Account(42, 'columnar', columnar=True)
+        >>> acc.apply(Transaction(100, datetime(2019, 5, 1)))
+        >>> acc.apply(Transaction(200, datetime(2019, 3, 31)))
+        >>> [str(t) for t in acc.transactions_between(datetime(2019, 3, 1),
+        ...                                           datetime(2019, 4, 1))]
+        ['200.0 USD at 2019-03-31 00:00:00']
+        >>> [str(t) for t in acc.transactions_between(date(2019, 3, 31),
+        ...                                           date(2019, 5, 1))]
+        ['200.0 USD at 2019-03-31 00:00:00']
+        """
+        start = self._bisect(bisect.bisect_left, start)
+        end = self._bisect(bisect.bisect_left, end)
+        if isinstance(self._transactions, TransactionBatch):
+            return list(map(self._transactions.__getitem__,
+                            self._order[start:end]))
+        return self._by_date[start:end]
+
+    def balance_in(self, currency, as_of=None, rates=None):
+        """Return the balance in currency of the transactions made up to
+        and including as_of (all of them by default), priced with the
+        rates of a RateTable (self.rates by default) on that date
+
+        Amounts are totalled per currency (kept running alongside the date
+        index), so each currency is converted once rather than once per
+        transaction.
+
+        >>> import io
+        >>> rates = RateTable.from_csv(io.StringIO(
+        ...     'date,currency,rate\\n'
+        ...     '2019-05-01,RUB,62.5\\n'
+        ...     '2019-05-01,EUR,0.9\\n'
+        ...     '2019-06-01,RUB,64.0\\n'))
+        >>> acc = Account(42, 'default')
+        >>> acc.rates = rates
+        >>> acc.apply(Transaction(100, datetime(2019, 5, 19)))
+        >>> acc.apply(Transaction(6400, datetime(2019, 5, 20), currency='RUB', usd_conversion_rate=64.0))
+        >>> acc.balance
+        200.0
+        >>> acc.balance_in('USD', datetime(2019, 5, 31))
+        202.4
+        >>> acc.balance_in('USD')
+        200.0
+        >>> acc.balance_in('EUR')
+        180.0
+        >>> acc.balance_in('USD', date(2019, 5, 19))
+        100.0
+        >>> acc.balance_in('GBP')  # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        NoRateError: no GBP rate
+        """
+        rates = rates if rates is not None else self.rates
+        if rates is None:
+            raise ValueError('rates should be provided')
+        if as_of is None:
+            amounts = self._amounts
+            as_of = date.max
+        else:
+            amounts = self._amounts_before(self._bisect(bisect.bisect_right,
+                                                        as_of))
+        usd = sum((amount / rates.decimal_rate(each, as_of)
+                   for each, amount in amounts.items() if amount),
+                  Decimal(0))
+        return float(usd * rates.decimal_rate(currency, as_of))
 
     @property
     def all_usd(self):
@@ -114,10 +495,90 @@ class Account:
         >>> acc.all_usd
         False
         """
-        for t in self._transactions:
-            if t.currency != 'USD':
-                return False
-        return True
+        return self._non_usd == 0
+
+    @property
+    def non_usd(self):
+        """Return the number of non-USD transactions"""
+        return self._non_usd
+
+    def _set_filename(self, filename):
+        if filename is not None:
+            self.filename = filename
+        if self.filename is None:
+            raise NoFilenameError(filename)
+
+        if not self.filename.endswith('.acc'):
+            self.filename += '.acc'
+
+    def _append(self, *records):
+        try:
+            for record in records:
+                pickle.dump(record, self._journal, pickle.HIGHEST_PROTOCOL)
+            self._journal.flush()
+        except (EnvironmentError, pickle.PicklingError) as err:
+            raise SaveError(err)
+        self._tail_length += len(records)
+        if self._tail_length > max(JOURNAL_MIN_TAIL, self._snapshot_length):
+            self.compact()
+
+    def open_journal(self, filename=None):
+        """Switch to journal mode: the account is saved once, then every
+        apply() (and rename) only appends one record to the file
+
+        load() replays the snapshot followed by the journal tail.
+
+        >>> timestamp = datetime(2019, 5, 19, 22, 20, 0)
+        >>> acc = Account(42, 'journal')
+        >>> acc.apply(Transaction(100, timestamp))
+        >>> filename = os.path.join(tempfile.gettempdir(), 'journal.acc')
+        >>> acc.open_journal(filename)
+        >>> size = os.path.getsize(filename)
+        >>> acc.apply(Transaction(6250, timestamp, currency='RUB', usd_conversion_rate=62.5))
+        >>> acc.name = 'renamed'
+        >>> os.path.getsize(filename) > size
+        True
+        >>> copy = Account(1, 'copy')
+        >>> copy.load(filename)
+        >>> copy.name, len(copy), copy.balance
+        ('renamed', 2, 200.0)
+
+        >>> acc.compact()
+        >>> copy.load(filename)
+        >>> copy.name, len(copy), copy.balance
+        ('renamed', 2, 200.0)
+        >>> acc.close_journal()
+        >>> os.remove(filename)
+        """
+        self.close_journal()
+        self.save(filename)
+        try:
+            self._journal = open(self.filename, 'ab')
+        except EnvironmentError as err:
+            raise SaveError(err)
+
+    def close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    @property
+    def journaling(self):
+        return self._journal is not None
+
+    def __getstate__(self):
+        # An open journal stays with this process; a pickled copy (e.g.
+        # one sent to a worker process) is an ordinary account
+        state = self.__dict__.copy()
+        state['_journal'] = None
+        return state
+
+    def compact(self):
+        """Rewrite the journal file as a single snapshot
+
+        Called automatically once the journal tail outgrows the snapshot.
+        """
+        self.save()
 
     def save(self, filename=None):
         """Save Account state in pickle format
@@ -148,25 +609,45 @@ class Account:
         >>> acc.save()
         >>> os.path.exists(dump_filename + '.acc')
         True
-        """
-        if filename is not None:
-            self.filename = filename
-        if self.filename is None:
-            raise NoFilenameError(filename)
-
-        if not self.filename.endswith('.acc'):
-            self.filename += '.acc'
 
-        fd = None
+        Saving keeps the permissions of the file it replaces; a new file
+        gets the usual ones for the umask
+        >>> os.chmod(dump_full_filename, 0o640)
+        >>> acc.save()
+        >>> oct(os.stat(dump_full_filename).st_mode & 0o777)
+        '0o640'
+        >>> os.remove(dump_full_filename)
+        >>> umask = os.umask(0o022)
+        >>> acc.save()
+        >>> oct(os.stat(dump_full_filename).st_mode & 0o777)
+        '0o644'
+        >>> _ = os.umask(umask)
+        >>> os.remove(dump_full_filename)
+        """
+        self._set_filename(filename)
+        journal = self._journal is not None
+        if journal:
+            self._journal.close()
+            self._journal = None
+        temp = None
         try:
-            fd = open(self.filename, 'wb')
-            data = (self._name, self._number, self._transactions)
-            pickle.dump(data, fd, pickle.HIGHEST_PROTOCOL)
+            # Write a new file and swap it in, so a failed save or
+            # compaction never leaves a half-written account behind
+            temp, fd = _create_temporary(self.filename)
+            with fd:
+                data = (self._name, self._number, self._transactions)
+                pickle.dump(data, fd, pickle.HIGHEST_PROTOCOL)
+            _copy_mode(self.filename, temp)
+            os.replace(temp, self.filename)
+            self._snapshot_length = len(self._transactions)
+            self._tail_length = 0
         except (EnvironmentError, pickle.PicklingError) as err:
+            if temp is not None and os.path.exists(temp):
+                os.remove(temp)
             raise SaveError(err)
         finally:
-            if fd is not None:
-                fd.close()
+            if journal:
+                self._journal = open(self.filename, 'ab')
 
     def load(self, filename=None):
         """Load Account state from pickle format
@@ -187,29 +668,82 @@ class Account:
         'default'
         >>> acc.number
         42
-        """
-        if filename is not None:
-            self.filename = filename
-        if self.filename is None:
-            raise NoFilenameError(filename)
-
-        if not self.filename.endswith('.acc'):
-            self.filename += '.acc'
+        >>> acc.balance
+        300.0
+        >>> acc.all_usd
+        False
 
+        Files that are not account snapshots raise LoadError
+        >>> for data in (b'not a pickle', pickle.dumps(42), b''):
+        ...     with open(dump_full_filename, 'wb') as fd:
+        ...         _ = fd.write(data)
+        ...     try:
+        ...         acc.load()
+        ...     except LoadError:
+        ...         print('LoadError')
+        LoadError
+        LoadError
+        LoadError
+        >>> os.remove(dump_full_filename)
+        """
+        self.close_journal()
+        self._set_filename(filename)
         fd = None
         try:
             fd = open(self.filename, 'rb')
             (name, number, transactions) = pickle.load(fd)
+            snapshot_length = len(transactions)
+            # Replay whatever a journal appended after the snapshot; a
+            # record cut short by a crash ends the tail
+            while True:
+                try:
+                    record = pickle.load(fd)
+                except (EOFError, pickle.UnpicklingError):
+                    break
+                if isinstance(record, str):
+                    name = record
+                else:
+                    transactions.append(record)
             self.name = name
             self._number = number
             self._transactions = transactions
-        except (EnvironmentError, pickle.PicklingError) as err:
+            self._reset_summary()
+            self._snapshot_length = snapshot_length
+            self._tail_length = len(transactions) - snapshot_length
+        except (EnvironmentError, pickle.UnpicklingError, EOFError,
+                AttributeError, ImportError, IndexError, KeyError,
+                OverflowError, TypeError, ValueError) as err:
             raise LoadError(err)
         finally:
             if fd is not None:
                 fd.close()
 
 
+def _create_temporary(filename):
+    # Create and open a new file under a unique name next to filename;
+    # open() gives it the usual permissions for the umask
+    while True:
+        temp = '{0}.{1}.tmp'.format(filename, os.urandom(8).hex())
+        try:
+            return temp, open(temp, 'xb')
+        except FileExistsError:
+            continue
+
+
+def _copy_mode(filename, temp):
+    # Give temp the permissions of filename, if that exists
+    try:
+        mode = os.stat(filename).st_mode & 0o7777
+    except FileNotFoundError:
+        return
+    os.chmod(temp, mode)
+
+
+_AMOUNT = operator.attrgetter('amount')
+_CURRENCY = operator.attrgetter('currency')
+_RATE = operator.attrgetter('usd_conversion_rate')
+
+
 class Transaction:
     """Transaction store info about currency transaction
     and calculate amount in USD (based on usd_conversion_rate)
@@ -217,6 +751,9 @@ class Transaction:
     usd_conversion_rate for USD must always be equal to 1.0
     """
 
+    __slots__ = ('_amount', '_date', '_currency', '_usd_conversion_rate',
+                 '_description')
+
     def __init__(self, amount, date, currency='USD', usd_conversion_rate=1.0,
                  description=None):
         """
@@ -284,6 +821,14 @@ class Transaction:
         """
         return self._amount / self._usd_conversion_rate
 
+    def __setstate__(self, state):
+        # Transactions pickled before __slots__ was added carry their
+        # attributes in a plain dict
+        if isinstance(state, tuple):
+            state = state[1]
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def __str__(self):
         return '{0} {1} at {2}'.format(
             self._amount, self._currency, self._date
@@ -298,6 +843,265 @@ class Transaction:
         )
 
 
+def _aggregate(transactions):
+    balance = 0.0
+    by_currency = collections.defaultdict(float)
+    by_day = collections.defaultdict(float)
+    for t in transactions:
+        usd = t.amount / t.usd_conversion_rate
+        balance += usd
+        by_currency[t.currency] += t.amount
+        by_day[t.date.date()] += usd
+    return balance, dict(by_currency), dict(by_day)
+
+
+class RateTable:
+    """Table of conversion rates by date and currency, in units of the
+    currency per USD (like Transaction.usd_conversion_rate)
+
+    A rate holds from its date until the next rate of the same currency.
+    USD is always 1.0. Lookups go through an LRU cache of maxsize entries.
+
+    >>> rates = RateTable()
+    >>> rates.add(date(2019, 5, 1), 'RUB', 62.5)
+    >>> rates.add(date(2019, 6, 1), 'RUB', 64.0)
+    >>> rates.rate('RUB', datetime(2019, 5, 31, 23, 59))
+    62.5
+    >>> rates.rate('RUB'), rates.rate('USD', date(1900, 1, 1))
+    (64.0, 1.0)
+    >>> rates.rate('RUB', date(2019, 4, 30))  # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ...
+    NoRateError: no RUB rate on or before 2019-04-30
+
+    The cache is left out when pickling, so accounts holding a RateTable
+    can still be pickled
+    >>> copy = pickle.loads(pickle.dumps(rates))
+    >>> copy.rate('RUB', date(2019, 5, 31))
+    62.5
+    """
+
+    def __init__(self, maxsize=4096):
+        self.__dates = collections.defaultdict(list)
+        self.__rates = collections.defaultdict(list)
+        self.__maxsize = maxsize
+        self.__cached_rate = functools.lru_cache(maxsize)(self.__decimal_rate)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_RateTable__cached_rate']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__cached_rate = functools.lru_cache(self.__maxsize)(
+            self.__decimal_rate)
+
+    @classmethod
+    def from_csv(cls, file, maxsize=4096):
+        """Return a RateTable read from a CSV file (or filename) with
+        date (YYYY-MM-DD), currency and rate columns and a header row"""
+        table = cls(maxsize)
+        fh = open(file, newline='') if isinstance(file, str) else file
+        try:
+            for row in csv.DictReader(fh):
+                table.add(date.fromisoformat(row['date']), row['currency'],
+                          float(row['rate']))
+        finally:
+            if fh is not file:
+                fh.close()
+        return table
+
+    def add(self, day, currency, rate):
+        dates = self.__dates[currency]
+        index = bisect.bisect_left(dates, day)
+        if index < len(dates) and dates[index] == day:
+            self.__rates[currency][index] = rate
+        else:
+            dates.insert(index, day)
+            self.__rates[currency].insert(index, rate)
+        self.__cached_rate.cache_clear()
+
+    def rate(self, currency, when=None):
+        return float(self.decimal_rate(currency, when))
+
+    def decimal_rate(self, currency, when=None):
+        # Rates change by the day, so every time of a day shares one
+        # cache entry
+        if isinstance(when, datetime):
+            when = when.date()
+        return self.__cached_rate(currency, when)
+
+    def __decimal_rate(self, currency, when):
+        if currency == 'USD':
+            return Decimal(1)
+        day = date.max if when is None else when
+        dates = self.__dates.get(currency, ())
+        index = bisect.bisect_right(dates, day)
+        if not index:
+            raise NoRateError('no {0} rate{1}'.format(
+                currency, '' if when is None else
+                ' on or before {0}'.format(day)))
+        return Decimal(str(self.__rates[currency][index - 1]))
+
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+_DAY = timedelta(days=1) // _MICROSECOND
+
+
+class TransactionBatch:
+    """Columnar store of Transactions
+
+    Each field lives in its own array: amounts and rates as doubles,
+    dates as microseconds since 1970, currencies as small integer codes
+    into a table of currency names; descriptions are kept only for
+    transactions that have one. A transaction costs about 26 bytes
+    instead of the 120 or so of a Transaction object and its datetime.
+
+    Indexing and iteration rebuild Transaction objects, so amounts come
+    back as floats. Dates must be naive datetimes.
+
+    >>> batch = TransactionBatch()
+    >>> batch.append(Transaction(100, datetime(2019, 5, 19, 22, 20, 0)))
+    >>> batch.extend([Transaction(6250, datetime(2019, 5, 20), currency='RUB', usd_conversion_rate=62.5, description='ticket')])
+    >>> len(batch)
+    2
+    >>> batch[-1]
+    Transaction(amount=6250.0, date=datetime.datetime(2019, 5, 20, 0, 0), currency=RUB, usd_conversion_rate=62.5, description='ticket')
+    >>> [str(t) for t in batch]
+    ['100.0 USD at 2019-05-19 22:20:00', '6250.0 RUB at 2019-05-20 00:00:00']
+    >>> batch.currencies
+    ['USD', 'RUB']
+    >>> batch[-3]
+    Traceback (most recent call last):
+    ...
+    IndexError: TransactionBatch index out of range
+    >>> batch.append(Transaction(1, datetime(2019, 5, 19).astimezone()))
+    Traceback (most recent call last):
+    ...
+    ValueError: columnar storage needs naive dates
+    """
+
+    def __init__(self, transactions=()):
+        self.amounts = array.array('d')
+        self.dates = array.array('q')
+        self.codes = array.array('H')
+        self.rates = array.array('d')
+        self.descriptions = {}
+        self.currencies = []
+        self.__code_of = {}
+        self.extend(transactions)
+
+    def __code(self, currency):
+        code = self.__code_of.get(currency)
+        if code is None:
+            code = self.__code_of[currency] = len(self.currencies)
+            self.currencies.append(currency)
+        return code
+
+    def append(self, transaction):
+        date = transaction.date
+        if date.tzinfo is not None:
+            raise ValueError('columnar storage needs naive dates')
+        code = self.__code(transaction.currency)
+        if transaction.description is not None:
+            self.descriptions[len(self.amounts)] = transaction.description
+        self.amounts.append(transaction.amount)
+        self.dates.append((date - _EPOCH) // _MICROSECOND)
+        self.codes.append(code)
+        self.rates.append(transaction.usd_conversion_rate)
+
+    def extend(self, transactions):
+        if isinstance(transactions, TransactionBatch):
+            # Column by column, translating the other batch's currency
+            # codes into this one's
+            codes = list(map(self.__code, transactions.currencies))
+            codes = array.array('H', map(codes.__getitem__,
+                                         transactions.codes))
+            offset = len(self)
+            self.descriptions.update(
+                (offset + index, description) for index, description
+                in transactions.descriptions.items())
+            self.amounts.extend(transactions.amounts)
+            self.dates.extend(transactions.dates)
+            self.codes.extend(codes)
+            self.rates.extend(transactions.rates)
+            return
+        for transaction in transactions:
+            self.append(transaction)
+
+    def __len__(self):
+        return len(self.amounts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('TransactionBatch index out of range')
+        return Transaction(self.amounts[index],
+                           _EPOCH + timedelta(microseconds=self.dates[index]),
+                           self.currencies[self.codes[index]],
+                           self.rates[index], self.descriptions.get(index))
+
+    def __iter__(self):
+        currencies = self.currencies
+        descriptions = self.descriptions
+        for index, (amount, date, code, rate) in enumerate(
+                zip(self.amounts, self.dates, self.codes, self.rates)):
+            yield Transaction(amount, _EPOCH + timedelta(microseconds=date),
+                              currencies[code], rate, descriptions.get(index))
+
+    def aggregate(self):
+        """Return (USD total, {currency: total amount}, {day: USD total})
+
+        Computed in one vectorized pass over the columns when NumPy is
+        installed, otherwise transaction by transaction.
+
+        >>> batch = TransactionBatch([
+        ...     Transaction(100, datetime(2019, 5, 19, 10)),
+        ...     Transaction(6250, datetime(2019, 5, 20), currency='RUB', usd_conversion_rate=62.5)])
+        >>> balance, by_currency, by_day = batch.aggregate()
+        >>> balance, sorted(by_currency.items())
+        (200.0, [('RUB', 6250.0), ('USD', 100.0)])
+        >>> sorted(by_day.items())
+        [(datetime.date(2019, 5, 19), 100.0), (datetime.date(2019, 5, 20), 100.0)]
+        """
+        try:
+            import numpy
+        except ImportError:
+            return _aggregate(self)
+
+        if not self.amounts:
+            return 0.0, {}, {}
+        amounts = numpy.frombuffer(self.amounts, numpy.float64)
+        usd = amounts / numpy.frombuffer(self.rates, numpy.float64)
+        by_currency = numpy.bincount(
+            numpy.frombuffer(self.codes, numpy.uint16), weights=amounts,
+            minlength=len(self.currencies))
+        days, day_index = numpy.unique(
+            numpy.frombuffer(self.dates, numpy.int64) // _DAY,
+            return_inverse=True)
+        by_day = numpy.bincount(day_index, weights=usd)
+        epoch = _EPOCH.date()
+        return (float(usd.sum()),
+                dict(zip(self.currencies, by_currency.tolist())),
+                {epoch + timedelta(days=day): total
+                 for day, total in zip(days.tolist(), by_day.tolist())})
+
+    def __getstate__(self):
+        return (self.amounts, self.dates, self.codes, self.rates,
+                self.descriptions, self.currencies)
+
+    def __setstate__(self, state):
+        (self.amounts, self.dates, self.codes, self.rates,
+         self.descriptions, self.currencies) = state
+        self.__code_of = {currency: code for code, currency
+                          in enumerate(self.currencies)}
+
+
 if __name__ == '__main__':
     import doctest
 
@@ -1,6 +1,63 @@
 #!/usr/bin/env python3
+import array
+import collections
+import importlib.util
+import itertools
+import math
+import mmap
 import os
 import pickle
+import re
+import string
+import struct
+import sys
+import zlib
+
+# Characters usable as XPM pixel codes: printable, no quote or backslash
+XPM_CHARS = "".join(c for c in string.ascii_letters + string.digits +
+                    string.punctuation + " " if c not in "\"\\")
+
+# Binary image files: a header, the palette (background first) as
+# length-prefixed UTF-8 strings, the number of pixels of each palette
+# color (from version 2 on), then the row-major plane of palette
+# indexes; compressed files hold a table of height + 1 row offsets
+# followed by each row compressed separately with zlib. Like the header,
+# palette indexes wider than a byte are stored little-endian.
+IMAGE_MAGIC = b"IMG\x1a"
+IMAGE_VERSION = 2
+COMPRESSED = 0x01
+_HEADER = struct.Struct("<4sBBBxIIQI")
+_COLOR_LENGTH = struct.Struct("<H")
+_ROW_OFFSET = struct.Struct("<Q")
+# Tile files: a header (ending with the offsets of the tile table and of
+# the palette block), then tile records (the index size followed by the
+# zlib-compressed little-endian indexes), tile tables (the (offset,
+# length) of each tile's record, zero for tiles that were never written)
+# and palette blocks (the number of colors, the colors as in image files
+# and their counts). Saving again appends the changed tiles, a new table
+# and a new palette block and only then rewrites the header, so the file
+# holds stale records until it is rewritten. Version 1 files have no
+# table offset in the header and a single table right after it.
+TILE_MAGIC = b"IMT\x1a"
+TILE_VERSION = 2
+TILE_SHIFT = 6
+TILE_SIZE = 1 << TILE_SHIFT
+TILE_MASK = TILE_SIZE - 1
+_TILE_HEADER = struct.Struct("<4sBxxxIIIQQ")
+_TILE_HEADER_V1 = struct.Struct("<4sBxxxIIIQ")
+_TILE_ENTRY = struct.Struct("<QI")
+_TILE_RECORD = struct.Struct("<B")
+_PALETTE_SIZE = struct.Struct("<I")
+
+_TYPECODES = {1: "B", 2: "H", 4: "I", 8: "Q"}
+_WIDER = {"B": "H", "H": "I", "I": "Q"}
+# Whether indexes must be byte-swapped between memory and files
+_SWAP = sys.byteorder != "little"
+
+# With dense=None an image switches from sparse to dense storage once this
+# fraction of its pixels differs from the background: a dict entry costs
+# well over 100 bytes, a dense pixel one to four
+DENSE_THRESHOLD = 1 / 64
 
 
 class ImageError(Exception):
@@ -27,15 +84,740 @@ class ExportError(ImageError):
     pass
 
 
+def _to_file_order(indexes, typecode):
+    # Return the indexes (an array or memoryview) in file byte order
+    if not _SWAP or array.array(typecode).itemsize == 1:
+        return indexes
+    indexes = array.array(typecode, indexes)
+    indexes.byteswap()
+    return indexes
+
+
+def _clip_steps(start, step, steps, size):
+    # The i in range(steps + 1) for which start + step * i is in range(size)
+    if step > 0:
+        first, last = -start, size - 1 - start
+    else:
+        first, last = start - size + 1, start
+    return range(max(first, 0), min(last, steps) + 1)
+
+
+def _from_file_order(data, typecode):
+    # Return an array of the indexes stored in the bytes-like data
+    indexes = array.array(typecode)
+    indexes.frombytes(data)
+    if _SWAP:
+        indexes.byteswap()
+    return indexes
+
+
+class _SparsePixels:
+    """Pixels kept in a dict of (x, y) -> color; only pixels that differ
+    from the background take up memory
+
+    counts holds the number of pixels of each non-background color.
+    """
+
+    def __init__(self, width, height, background, data=None):
+        self.width = width
+        self.height = height
+        self.background = background
+        self.data = {} if data is None else data
+        self.counts = collections.Counter(self.data.values())
+
+    def __len__(self):
+        return len(self.data)
+
+    def color_counts(self):
+        counts = dict(self.counts)
+        if len(self.data) < self.width * self.height:
+            counts[self.background] = (self.width * self.height -
+                                       len(self.data))
+        return counts
+
+    def __uncount(self, color):
+        count = self.counts[color] - 1
+        if count:
+            self.counts[color] = count
+        else:
+            del self.counts[color]
+
+    def get(self, x, y):
+        return self.data.get((x, y), self.background)
+
+    def set(self, x, y, color):
+        if color == self.background:
+            old = self.data.pop((x, y), None)
+        else:
+            old = self.data.get((x, y))
+            self.data[x, y] = color
+            self.counts[color] += 1
+        if old is not None:
+            self.__uncount(old)
+
+    def items(self):
+        return self.data.items()
+
+    def fill(self, x0, y0, x1, y1, color):
+        coordinates = itertools.product(range(x0, x1), range(y0, y1))
+        self.set_many(coordinates, color)
+
+    def set_many(self, coordinates, color):
+        data = self.data
+        if color == self.background:
+            for coordinate in coordinates:
+                old = data.pop(coordinate, None)
+                if old is not None:
+                    self.__uncount(old)
+        else:
+            for coordinate in coordinates:
+                old = data.get(coordinate)
+                if old is not None:
+                    self.__uncount(old)
+                data[coordinate] = color
+                self.counts[color] += 1
+
+    def to_dense(self):
+        pixels = _DensePixels(self.width, self.height, self.background)
+        for (x, y), color in self.data.items():
+            pixels.set(x, y, color)
+        return pixels
+
+    def index_rows(self):
+        # Build one row of indexes at a time from the pixels set in it
+        palette = [self.background] + list(self.counts)
+        counts = ([self.width * self.height - len(self.data)] +
+                  list(self.counts.values()))
+        indexes = {color: index for index, color in enumerate(palette)}
+        itemsize = 1
+        while len(palette) > 1 << (8 * itemsize):
+            itemsize *= 2
+        typecode = _TYPECODES[itemsize]
+        by_row = collections.defaultdict(list)
+        for (x, y), color in self.data.items():
+            by_row[y].append((x, indexes[color]))
+        blank = array.array(typecode, [0]) * self.width
+
+        def rows():
+            for y in range(self.height):
+                row = blank
+                if y in by_row:
+                    row = array.array(typecode, blank)
+                    for x, index in by_row[y]:
+                        row[x] = index
+                yield row
+
+        return palette, counts, itemsize, rows()
+
+    def row(self, y, x0, x1):
+        get, background = self.data.get, self.background
+        return [get((x, y), background) for x in range(x0, x1)]
+
+    def put_row(self, x0, y, colors):
+        for x, color in enumerate(colors, x0):
+            self.set(x, y, color)
+
+
+class _PalettePixels:
+    """Base for pixel storages that keep palette indexes: palette[i] is
+    the color of index i, with the background at index 0, and counts[i]
+    the number of pixels that use it
+
+    Subclasses store indexes in arrays of the typecode returned by
+    typecode() and widen them in widen() when the palette outgrows it.
+    """
+
+    def __init__(self, width, height, background):
+        self.width = width
+        self.height = height
+        self.background = background
+        self.palette = [background]
+        self.indexes = {background: 0}
+        self.counts = [width * height]
+
+    def __len__(self):
+        return self.width * self.height - self.counts[0]
+
+    def color_counts(self):
+        return {color: count for color, count in zip(self.palette,
+                                                     self.counts) if count}
+
+    def index(self, color):
+        index = self.indexes.get(color)
+        return self.__add_color(color) if index is None else index
+
+    def __add_color(self, color):
+        index = len(self.palette)
+        if index == 1 << (8 * array.array(self.typecode()).itemsize):
+            self.widen(_WIDER[self.typecode()])
+        self.palette.append(color)
+        self.indexes[color] = index
+        self.counts.append(0)
+        return index
+
+    def to_indexes(self, colors):
+        for color in set(colors) - self.indexes.keys():
+            self.__add_color(color)
+        return array.array(self.typecode(),
+                           map(self.indexes.__getitem__, colors))
+
+    def count(self, indexes, sign=1):
+        # Add (or with sign=-1 remove) the pixels with the given indexes to
+        # the counts; runs of one index, common after fills, are cheap
+        if not indexes:
+            return
+        if indexes.count(indexes[0]) == len(indexes):
+            self.counts[indexes[0]] += sign * len(indexes)
+            return
+        for index, count in collections.Counter(indexes).items():
+            self.counts[index] += sign * count
+
+
+class _DensePixels(_PalettePixels):
+    """Pixels kept as one palette index per pixel in a row-major array of
+    width * height items
+
+    The array starts with one byte per pixel and is widened when the
+    palette outgrows it.
+    """
+
+    def __init__(self, width, height, background):
+        super().__init__(width, height, background)
+        self.data = array.array("B", bytes(width * height))
+
+    def typecode(self):
+        return self.data.typecode
+
+    def widen(self, typecode):
+        self.data = array.array(typecode, self.data)
+
+    def get(self, x, y):
+        return self.palette[self.data[y * self.width + x]]
+
+    def set(self, x, y, color):
+        index = self.index(color)
+        offset = y * self.width + x
+        self.counts[self.data[offset]] -= 1
+        self.counts[index] += 1
+        self.data[offset] = index
+
+    def fill(self, x0, y0, x1, y1, color):
+        if x1 <= x0 or y1 <= y0:
+            return
+        index = self.index(color)
+        width = x1 - x0
+        run = array.array(self.data.typecode, [index]) * width
+        for y in range(y0, y1):
+            start = y * self.width + x0
+            self.count(self.data[start:start + width], -1)
+            self.data[start:start + width] = run
+        self.counts[index] += width * (y1 - y0)
+
+    def set_many(self, coordinates, color):
+        index = self.index(color)
+        data, width = self.data, self.width
+        counts = self.counts
+        for x, y in coordinates:
+            offset = y * width + x
+            counts[data[offset]] -= 1
+            counts[index] += 1
+            data[offset] = index
+
+    def row(self, y, x0, x1):
+        start = y * self.width
+        return list(map(self.palette.__getitem__,
+                        self.data[start + x0:start + x1]))
+
+    def put_row(self, x0, y, colors):
+        indexes = self.to_indexes(colors)
+        start = y * self.width + x0
+        stop = start + len(colors)
+        self.count(self.data[start:stop], -1)
+        self.count(indexes)
+        self.data[start:stop] = indexes
+
+    def items(self):
+        palette, width = self.palette, self.width
+        for offset, index in enumerate(self.data):
+            if index:
+                y, x = divmod(offset, width)
+                yield (x, y), palette[index]
+
+    def index_rows(self):
+        # Return the palette, its counts, the bytes per index and each
+        # row's indexes
+        view = memoryview(self.data)
+        rows = (view[y * self.width:(y + 1) * self.width]
+                for y in range(self.height))
+        return self.palette, self.counts, self.data.itemsize, rows
+
+
+class _TiledPixels(_PalettePixels):
+    """Pixels kept in TILE_SIZE x TILE_SIZE tiles of palette indexes
+
+    Tiles that were never written take no memory. Every write marks its
+    tile dirty, so once the tiles are in a tile file, save() only appends
+    the tiles changed since.
+    """
+
+    def __init__(self, width, height, background):
+        super().__init__(width, height, background)
+        self.__typecode = "B"
+        self.tiles = {}
+        self.dirty = set()
+        self.filename = None
+        self.stored = {}
+        self.stored_index = 0
+        self.garbage = 0
+
+    def typecode(self):
+        return self.__typecode
+
+    def widen(self, typecode):
+        self.__typecode = typecode
+        for key, tile in self.tiles.items():
+            self.tiles[key] = array.array(typecode, tile)
+
+    def __tile(self, tx, ty):
+        tile = self.tiles.get((tx, ty))
+        if tile is None:
+            tile = array.array(self.__typecode, [0]) * (TILE_SIZE * TILE_SIZE)
+            self.tiles[tx, ty] = tile
+        self.dirty.add((tx, ty))
+        return tile
+
+    @staticmethod
+    def __spans(x0, x1):
+        # Yield (tile column, start, stop in the tile row, offset from x0)
+        # for each tile the pixels x0 <= x < x1 of a row fall in
+        x = x0
+        while x < x1:
+            tx = x >> TILE_SHIFT
+            stop = min(x1, (tx + 1) << TILE_SHIFT)
+            yield tx, x & TILE_MASK, (x & TILE_MASK) + stop - x, x - x0
+            x = stop
+
+    def get(self, x, y):
+        tile = self.tiles.get((x >> TILE_SHIFT, y >> TILE_SHIFT))
+        if tile is None:
+            return self.background
+        return self.palette[tile[(y & TILE_MASK) << TILE_SHIFT |
+                                 (x & TILE_MASK)]]
+
+    def set(self, x, y, color):
+        index = self.index(color)
+        tile = self.__tile(x >> TILE_SHIFT, y >> TILE_SHIFT)
+        offset = (y & TILE_MASK) << TILE_SHIFT | (x & TILE_MASK)
+        self.counts[tile[offset]] -= 1
+        self.counts[index] += 1
+        tile[offset] = index
+
+    def fill(self, x0, y0, x1, y1, color):
+        index = self.index(color)
+        run = array.array(self.__typecode, [index]) * TILE_SIZE
+        spans = list(self.__spans(x0, x1))
+        for ty, top, bottom, _ in self.__spans(y0, y1):
+            for tx, start, stop, _ in spans:
+                # A new tile is all background, and a tile that is
+                # covered completely is counted and replaced in one go
+                new = (tx, ty) not in self.tiles
+                if new:
+                    self.counts[0] -= (stop - start) * (bottom - top)
+                elif stop - start == bottom - top == TILE_SIZE:
+                    self.count(self.tiles[tx, ty], -1)
+                    self.tiles[tx, ty] = run * TILE_SIZE
+                    self.dirty.add((tx, ty))
+                    continue
+                tile = self.__tile(tx, ty)
+                for y in range(top, bottom):
+                    base = y << TILE_SHIFT
+                    if not new:
+                        self.count(tile[base + start:base + stop], -1)
+                    tile[base + start:base + stop] = run[:stop - start]
+        self.counts[index] += (x1 - x0) * (y1 - y0)
+
+    def set_many(self, coordinates, color):
+        for x, y in coordinates:
+            self.set(x, y, color)
+
+    def row(self, y, x0, x1):
+        colors = []
+        base = (y & TILE_MASK) << TILE_SHIFT
+        for tx, start, stop, _ in self.__spans(x0, x1):
+            tile = self.tiles.get((tx, y >> TILE_SHIFT))
+            if tile is None:
+                colors.extend([self.background] * (stop - start))
+            else:
+                colors.extend(map(self.palette.__getitem__,
+                                  tile[base + start:base + stop]))
+        return colors
+
+    def put_row(self, x0, y, colors):
+        indexes = self.to_indexes(colors)
+        base = (y & TILE_MASK) << TILE_SHIFT
+        for tx, start, stop, offset in self.__spans(x0, x0 + len(colors)):
+            tile = self.__tile(tx, y >> TILE_SHIFT)
+            self.count(tile[base + start:base + stop], -1)
+            part = indexes[offset:offset + stop - start]
+            self.count(part)
+            tile[base + start:base + stop] = part
+
+    def items(self):
+        palette = self.palette
+        for (tx, ty), tile in self.tiles.items():
+            for offset, index in enumerate(tile):
+                if index:
+                    yield ((tx << TILE_SHIFT | offset & TILE_MASK,
+                            ty << TILE_SHIFT | offset >> TILE_SHIFT),
+                           palette[index])
+
+    def index_rows(self):
+        blank = array.array(self.__typecode, [0]) * TILE_SIZE
+
+        def rows():
+            for y in range(self.height):
+                row = array.array(self.__typecode)
+                base = (y & TILE_MASK) << TILE_SHIFT
+                for tx, start, stop, _ in self.__spans(0, self.width):
+                    tile = self.tiles.get((tx, y >> TILE_SHIFT), blank)
+                    if tile is blank:
+                        row.extend(blank[:stop - start])
+                    else:
+                        row.extend(tile[base + start:base + stop])
+                yield row
+
+        return self.palette, self.counts, blank.itemsize, rows()
+
+    def __table(self, stored):
+        # The tile table for the given {(tx, ty): (offset, length)}
+        columns = (self.width + TILE_MASK) >> TILE_SHIFT
+        rows = (self.height + TILE_MASK) >> TILE_SHIFT
+        table = bytearray(columns * rows * _TILE_ENTRY.size)
+        for (tx, ty), entry in stored.items():
+            _TILE_ENTRY.pack_into(table, (ty * columns + tx) *
+                                  _TILE_ENTRY.size, *entry)
+        return table
+
+    def __palette_block(self):
+        block = [_PALETTE_SIZE.pack(len(self.palette))]
+        for color in self.palette:
+            encoded = color.encode("utf8")
+            block.append(_COLOR_LENGTH.pack(len(encoded)))
+            block.append(encoded)
+        block.append(struct.pack("<{0}Q".format(len(self.counts)),
+                                 *self.counts))
+        return b"".join(block)
+
+    def __append(self, fh, keys):
+        # Append the records of the given tiles, a copy of the table and a
+        # palette block, then point the header at them: until that single
+        # write the header still refers to the last saved table and
+        # palette, so an interrupted save leaves the file as it was
+        fh.seek(0, os.SEEK_END)
+        stored = dict(self.stored)
+        garbage = self.garbage + self.stored_index
+        for key in keys:
+            tile = self.tiles[key]
+            record = (_TILE_RECORD.pack(tile.itemsize) +
+                      zlib.compress(_to_file_order(tile, tile.typecode)))
+            garbage += stored.get(key, (0, 0))[1]
+            stored[key] = (fh.tell(), len(record))
+            fh.write(record)
+        table = self.__table(stored)
+        table_offset = fh.tell()
+        fh.write(table)
+        palette = fh.tell()
+        block = self.__palette_block()
+        fh.write(block)
+        fh.flush()
+        os.fsync(fh.fileno())
+        fh.seek(0)
+        fh.write(_TILE_HEADER.pack(TILE_MAGIC, TILE_VERSION, self.width,
+                                   self.height, TILE_SIZE, table_offset,
+                                   palette))
+        self.stored = stored
+        self.stored_index = len(table) + len(block)
+        self.garbage = garbage
+
+    def save(self, filename):
+        """Write the tiles to a tile file
+
+        If the tiles came from, or were last saved to, the same file, only
+        the dirty tiles are appended; the file is rewritten from scratch
+        once stale records outweigh the live ones.
+        """
+        live = sum(length for _, length in self.stored.values())
+        if (filename == self.filename and os.path.exists(filename) and
+                self.garbage <= live):
+            with open(filename, "r+b") as fh:
+                self.__append(fh, sorted(self.dirty))
+        else:
+            temporary = filename + ".tmp"
+            self.stored, self.stored_index, self.garbage = {}, 0, 0
+            with open(temporary, "wb") as fh:
+                fh.write(bytes(_TILE_HEADER.size))
+                self.__append(fh, sorted(self.tiles))
+            os.replace(temporary, filename)
+            self.filename = filename
+        self.dirty.clear()
+
+    @classmethod
+    def open(cls, fh, filename):
+        header = fh.read(_TILE_HEADER.size)
+        if header[4:5] == b"\x01":
+            # Version 1 files keep their table right after the header
+            (magic, version, width, height, tile_size,
+             palette) = _TILE_HEADER_V1.unpack_from(header)
+            table_offset = header_size = _TILE_HEADER_V1.size
+        else:
+            header_size = _TILE_HEADER.size
+            (magic, version, width, height, tile_size, table_offset,
+             palette) = _TILE_HEADER.unpack(header)
+        if version > TILE_VERSION or tile_size != TILE_SIZE:
+            raise ValueError("unsupported tile file version")
+        fh.seek(palette)
+        colors, = _PALETTE_SIZE.unpack(fh.read(_PALETTE_SIZE.size))
+        if not colors:
+            raise ValueError("empty palette")
+        names = []
+        for _ in range(colors):
+            length, = _COLOR_LENGTH.unpack(fh.read(_COLOR_LENGTH.size))
+            names.append(fh.read(length).decode("utf8"))
+        counts = list(struct.unpack("<{0}Q".format(colors),
+                                    fh.read(8 * colors)))
+        pixels = cls(width, height, names[0])
+        for color in names[1:]:
+            pixels.index(color)
+        pixels.counts = counts
+        columns = (width + TILE_MASK) >> TILE_SHIFT
+        rows = (height + TILE_MASK) >> TILE_SHIFT
+        fh.seek(table_offset)
+        table = fh.read(columns * rows * _TILE_ENTRY.size)
+        for i, (offset, length) in enumerate(_TILE_ENTRY.iter_unpack(table)):
+            if not offset:
+                continue
+            fh.seek(offset)
+            record = fh.read(length)
+            itemsize, = _TILE_RECORD.unpack_from(record)
+            if itemsize not in _TYPECODES:
+                raise ValueError("invalid palette index size")
+            tile = _from_file_order(zlib.decompress(
+                record[_TILE_RECORD.size:]), _TYPECODES[itemsize])
+            if len(tile) != TILE_SIZE * TILE_SIZE or max(tile) >= colors:
+                raise ValueError("invalid tile record")
+            if tile.typecode != pixels.typecode():
+                tile = array.array(pixels.typecode(), tile)
+            ty, tx = divmod(i, columns)
+            pixels.tiles[tx, ty] = tile
+            pixels.stored[tx, ty] = (offset, length)
+        fh.seek(0, os.SEEK_END)
+        pixels.stored_index = len(table) + len(pixels.__palette_block())
+        pixels.garbage = (fh.tell() - header_size -
+                          sum(length for _, length in
+                              pixels.stored.values()) -
+                          pixels.stored_index)
+        # Version 1 files are rewritten in the current format when saved
+        pixels.filename = filename if version == TILE_VERSION else None
+        return pixels
+
+
+class _MappedPixels:
+    """Read-only pixels decoded on demand from a memory-mapped image file
+
+    Opening only reads the header, palette and color counts; rows are
+    read, and if need be decompressed, when they are first accessed, with
+    the last decompressed row cached for row-by-row access.
+    """
+
+    def __init__(self, buffer, width, height, palette, counts, itemsize,
+                 count, flags, offset):
+        self.width = width
+        self.height = height
+        self.background = palette[0]
+        self.palette = palette
+        self.__counts = counts
+        self.itemsize = itemsize
+        self.count = count
+        self.compressed = bool(flags & COMPRESSED)
+        self.offset = offset
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.cached = (None, None)
+
+    @classmethod
+    def open(cls, fh):
+        buffer = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, itemsize, flags, width, height, count,
+         colors) = _HEADER.unpack_from(buffer)
+        if magic != IMAGE_MAGIC or version > IMAGE_VERSION:
+            raise ValueError("unsupported image file version")
+        if itemsize not in _TYPECODES:
+            raise ValueError("invalid palette index size")
+        offset = _HEADER.size
+        palette = []
+        for _ in range(colors):
+            length, = _COLOR_LENGTH.unpack_from(buffer, offset)
+            offset += _COLOR_LENGTH.size
+            palette.append(buffer[offset:offset + length].decode("utf8"))
+            offset += length
+        counts = None
+        if version >= 2:
+            counts = list(struct.unpack_from("<{0}Q".format(colors), buffer,
+                                             offset))
+            offset += struct.calcsize("<{0}Q".format(colors))
+        if flags & COMPRESSED:
+            table = (height + 1) * _ROW_OFFSET.size
+            if len(buffer) < offset + table:
+                raise ValueError("truncated image file")
+            size = table + _ROW_OFFSET.unpack_from(
+                buffer, offset + table - _ROW_OFFSET.size)[0]
+        else:
+            size = width * height * itemsize
+        if len(buffer) < offset + size:
+            raise ValueError("truncated image file")
+        return cls(buffer, width, height, palette, counts, itemsize, count,
+                   flags, offset)
+
+    def close(self):
+        self.cached = (None, None)
+        self.view.release()
+        self.buffer.close()
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def counts(self):
+        # Version 1 files have no color counts, so count on first use
+        if self.__counts is None:
+            counter = collections.Counter()
+            for y in range(self.height):
+                counter.update(self.indexes(y))
+            self.__counts = [counter[index]
+                             for index in range(len(self.palette))]
+        return self.__counts
+
+    def color_counts(self):
+        return {color: count for color, count in zip(self.palette,
+                                                     self.counts) if count}
+
+    def indexes(self, y):
+        size = self.width * self.itemsize
+        typecode = _TYPECODES[self.itemsize]
+        if not self.compressed:
+            start = self.offset + y * size
+            if _SWAP:
+                return _from_file_order(self.view[start:start + size],
+                                        typecode)
+            return self.view[start:start + size].cast(typecode)
+        if self.cached[0] != y:
+            table = self.offset + y * _ROW_OFFSET.size
+            start = _ROW_OFFSET.unpack_from(self.buffer, table)[0]
+            stop = _ROW_OFFSET.unpack_from(self.buffer,
+                                           table + _ROW_OFFSET.size)[0]
+            data = self.offset + (self.height + 1) * _ROW_OFFSET.size
+            row = zlib.decompress(self.view[data + start:data + stop])
+            if len(row) != size:
+                raise zlib.error("row {0} has the wrong size".format(y))
+            self.cached = (y, _from_file_order(row, typecode) if _SWAP
+                           else memoryview(row).cast(typecode))
+        return self.cached[1]
+
+    def get(self, x, y):
+        return self.palette[self.indexes(y)[x]]
+
+    def row(self, y, x0, x1):
+        return list(map(self.palette.__getitem__, self.indexes(y)[x0:x1]))
+
+    def items(self):
+        palette = self.palette
+        for y in range(self.height):
+            for x, index in enumerate(self.indexes(y)):
+                if index:
+                    yield (x, y), palette[index]
+
+    def index_rows(self):
+        return (self.palette, self.counts, self.itemsize,
+                (self.indexes(y) for y in range(self.height)))
+
+    def to_dense(self):
+        pixels = _DensePixels(self.width, self.height, self.background)
+        pixels.palette = list(self.palette)
+        pixels.indexes = {color: index
+                          for index, color in enumerate(self.palette)}
+        pixels.data = array.array(_TYPECODES[self.itemsize])
+        for y in range(self.height):
+            pixels.data.frombytes(memoryview(self.indexes(y)).cast("B"))
+        pixels.counts = list(self.counts)
+        return pixels
+
+
+def _write_pixels(fh, pixels, compress):
+    palette, counts, itemsize, rows = pixels.index_rows()
+    rows = (_to_file_order(row, _TYPECODES[itemsize]) for row in rows)
+    flags = COMPRESSED if compress else 0
+    fh.write(_HEADER.pack(IMAGE_MAGIC, IMAGE_VERSION, itemsize, flags,
+                          pixels.width, pixels.height, len(pixels),
+                          len(palette)))
+    for color in palette:
+        encoded = color.encode("utf8")
+        fh.write(_COLOR_LENGTH.pack(len(encoded)))
+        fh.write(encoded)
+    fh.write(struct.pack("<{0}Q".format(len(counts)), *counts))
+    if not compress:
+        for row in rows:
+            fh.write(row)
+        return
+    table = fh.tell()
+    offsets = [0]
+    fh.write(bytes(_ROW_OFFSET.size * (pixels.height + 1)))
+    for row in rows:
+        compressed = zlib.compress(row)
+        fh.write(compressed)
+        offsets.append(offsets[-1] + len(compressed))
+    fh.seek(table)
+    fh.write(b"".join(map(_ROW_OFFSET.pack, offsets)))
+
+
 class Image:
     def __init__(self, width, height, filename="",
-                 background="#FFFFFF"):
+                 background="#FFFFFF", dense=None, tiled=False):
+        """An image of width x height pixels
+
+        dense=False keeps only the non-background pixels in a dict,
+        dense=True keeps a palette index for every pixel in an array, and
+        dense=None (the default) starts sparse and switches to dense once
+        more than DENSE_THRESHOLD of the pixels have been set.
+
+        tiled=True keeps the pixels in tiles instead and saves them to a
+        tile file, where saving again only writes the changed tiles.
+
+        >>> image = Image(16, 16)
+        >>> for x in range(4):
+        ...     image[x, 0] = "#000000"
+        >>> image.dense
+        False
+        >>> image[4, 0] = "#000000"
+        >>> image.dense, image[4, 0], image[5, 0]
+        (True, '#000000', '#FFFFFF')
+        >>> image.color_counts() == {"#000000": 5, "#FFFFFF": 251}
+        True
+        >>> image = Image(16, 16, dense=False)
+        >>> image.fill_rect(0, 0, 16, 16, "#000000")
+        >>> image.dense
+        False
+        """
         self.filename = filename
         self.__background = background
-        self.__data = {}
         self.__height = height
         self.__width = width
-        self.__colors = {self.__background}
+        self.__dense = dense
+        if tiled:
+            self.__data = _TiledPixels(width, height, background)
+        elif dense:
+            self.__data = _DensePixels(width, height, background)
+        else:
+            self.__data = _SparsePixels(width, height, background)
 
     @property
     def background(self):
@@ -51,51 +833,597 @@ class Image:
 
     @property
     def colors(self):
-        return set(self.__colors)
+        return set(self.__data.color_counts()) | {self.__background}
 
-    def __getitem__(self, coordinate):
+    def color_counts(self):
+        """Return a dict of each color in use -> its number of pixels
+
+        The counts are kept up to date as pixels change, so this costs
+        O(colors) rather than a scan of the image.
+
+        >>> for options in ({"dense": False}, {"dense": True},
+        ...                 {"tiled": True}):
+        ...     image = Image(3, 2, **options)
+        ...     image[0, 0] = image[1, 0] = "#000000"
+        ...     image[1, 0] = "#FF0000"
+        ...     del image[0, 0]
+        ...     image[2, 1] = "#FF0000"
+        ...     print(sorted(image.color_counts().items()))
+        [('#FF0000', 2), ('#FFFFFF', 4)]
+        [('#FF0000', 2), ('#FFFFFF', 4)]
+        [('#FF0000', 2), ('#FFFFFF', 4)]
+        """
+        return self.__data.color_counts()
+
+    @property
+    def dense(self):
+        return isinstance(self.__data, _DensePixels)
+
+    @property
+    def tiled(self):
+        return isinstance(self.__data, _TiledPixels)
+
+    def __make_dense_if_full(self, pending=0):
+        # pending is the most pixels a write about to happen can add, so
+        # that large writes go straight to dense storage
+        if (isinstance(self.__data, _SparsePixels) and
+                (self.__dense or (self.__dense is None and
+                                  len(self.__data) + pending >
+                                  DENSE_THRESHOLD * self.__width *
+                                  self.__height))):
+            self.__data = self.__data.to_dense()
+
+    def __make_writable(self):
+        if isinstance(self.__data, _MappedPixels):
+            self.__data = self.__data.to_dense()
+
+    def __check(self, coordinate):
         assert len(coordinate) == 2, "coordinate should be 2-tuple"
-        if (not 0 <= coordinate[0] <= self.__width or
-                not 0 <= coordinate[1] <= self.__height):
+        x, y = coordinate
+        if not (0 <= x < self.__width and 0 <= y < self.__height):
             raise CoordinateError(str(coordinate))
-        return self.__data.get(tuple(coordinate), self.__background)
+        return x, y
+
+    def __getitem__(self, coordinate):
+        """Return the color at coordinate, an (x, y) tuple
+
+        x must be in range(width) and y in range(height), for reads,
+        writes and deletions alike.
+
+        >>> image = Image(3, 2)
+        >>> image[2, 1]
+        '#FFFFFF'
+        >>> image[3, 0]  # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        CoordinateError: (3, 0)
+        >>> image[0, 2] = "#000000"  # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        CoordinateError: (0, 2)
+        >>> del image[-1, 0]  # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        CoordinateError: (-1, 0)
+        >>> image.color_counts()
+        {'#FFFFFF': 6}
+        """
+        return self.__data.get(*self.__check(coordinate))
 
     def __setitem__(self, coordinate, color):
-        assert len(coordinate) == 2, "coordinate should be 2-tuple"
-        if (not 0 <= coordinate[0] <= self.__width or
-                not 0 <= coordinate[1] <= self.__height):
-            raise CoordinateError(str(coordinate))
-        if color == self.__background:
-            self.__data.pop(tuple(coordinate), None)
-        else:
-            self.__data[tuple(coordinate)] = color
-            self.__colors.add(color)
+        x, y = self.__check(coordinate)
+        self.set_unchecked(x, y, color)
 
     def __delitem__(self, coordinate):
-        assert len(coordinate) == 2, "coordinate should be 2-tuple"
-        if (not 0 <= coordinate[0] <= self.__width or
-                not 0 <= coordinate[1] <= self.__height):
-            raise CoordinateError(str(coordinate))
-        self.__data.pop(tuple(coordinate), None)
+        x, y = self.__check(coordinate)
+        self.set_unchecked(x, y, self.__background)
+
+    def get_unchecked(self, x, y):
+        """Return the color at (x, y) without validating the coordinate
+
+        For inner loops whose coordinates are known to be in range;
+        out-of-range ones give wrong pixels or errors other than
+        CoordinateError.
+        """
+        return self.__data.get(x, y)
+
+    def set_unchecked(self, x, y, color):
+        """Set the color at (x, y) without validating the coordinate; see
+        get_unchecked()"""
+        pixels = self.__data
+        if pixels.__class__ is _MappedPixels:
+            pixels = self.__data = pixels.to_dense()
+        pixels.set(x, y, color)
+        if pixels.__class__ is _SparsePixels and color != self.__background:
+            self.__make_dense_if_full()
+
+    def __check_region(self, x, y, width, height):
+        if (width < 0 or height < 0 or
+                not 0 <= x <= x + width <= self.__width or
+                not 0 <= y <= y + height <= self.__height):
+            raise CoordinateError(str((x, y, width, height)))
+
+    def fill_rect(self, x, y, width, height, color):
+        """Set every pixel of the width x height rectangle at (x, y)
+
+        The bounds are checked once and whole rows are written at a time.
+        An image with dense=None switches to dense storage before a fill
+        large enough to need it.
+
+        >>> image = Image(4, 3, dense=True)
+        >>> image.fill_rect(1, 1, 2, 2, "#FF0000")
+        >>> [image[x, 1] for x in range(4)]
+        ['#FFFFFF', '#FF0000', '#FF0000', '#FFFFFF']
+        >>> image.color_counts() == {"#FF0000": 4, "#FFFFFF": 8}
+        True
+        >>> image.fill_rect(3, 0, 2, 1,
+        ...                 "#000000")  # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        CoordinateError: (3, 0, 2, 1)
+        >>> image = Image(64, 64)
+        >>> image.fill_rect(0, 0, 16, 16, "#000000")
+        >>> image.dense, image.color_counts()["#000000"]
+        (True, 256)
+        """
+        self.__check_region(x, y, width, height)
+        if not width or not height:
+            return
+        self.__make_writable()
+        if color != self.__background:
+            self.__make_dense_if_full(width * height)
+        self.__data.fill(x, y, x + width, y + height, color)
+
+    def set_many(self, coordinates, color):
+        """Set every pixel in the coordinates sequence to color
+
+        Nothing is set unless every coordinate is in range.
+
+        >>> image = Image(4, 3)
+        >>> image.set_many([(0, 2), (3, 2)], "#00FF00")
+        >>> image[0, 2], image[3, 2], image[1, 2]
+        ('#00FF00', '#00FF00', '#FFFFFF')
+        >>> image.set_many([(0, 0), (4, 0)],
+        ...                "#000000")  # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        CoordinateError: coordinates out of range
+        >>> image[0, 0]
+        '#FFFFFF'
+        """
+        coordinates = [tuple(coordinate) for coordinate in coordinates]
+        if not coordinates:
+            return
+        xs, ys = zip(*coordinates)
+        if (min(xs) < 0 or max(xs) >= self.__width or
+                min(ys) < 0 or max(ys) >= self.__height):
+            raise CoordinateError("coordinates out of range")
+        self.__make_writable()
+        if color != self.__background:
+            self.__make_dense_if_full(len(coordinates))
+        self.__data.set_many(coordinates, color)
+
+    def __fill_rows(self, spans, color):
+        # spans is an iterable of (y, x0, x1); pixels outside the image
+        # are clipped
+        clipped = []
+        for y, x0, x1 in spans:
+            x0, x1 = max(x0, 0), min(x1, self.__width)
+            if 0 <= y < self.__height and x0 < x1:
+                clipped.append((y, x0, x1))
+        self.__make_writable()
+        if color != self.__background:
+            self.__make_dense_if_full(sum(x1 - x0 for _, x0, x1 in clipped))
+        for y, x0, x1 in clipped:
+            self.__data.fill(x0, y, x1, y + 1, color)
+
+    def draw_line(self, x0, y0, x1, y1, color):
+        """Draw a line from (x0, y0) to (x1, y1) with Bresenham's algorithm
+
+        Mostly horizontal lines are written as one run per row. Each
+        step along the longer axis has its pixel worked out directly, and
+        only the steps inside the image are taken.
+
+        >>> def show(image):
+        ...     for y in range(image.height):
+        ...         print("".join("#" if image[x, y] == "#000000" else "-"
+        ...                       for x in range(image.width)))
+        >>> image = Image(7, 4)
+        >>> image.draw_line(0, 0, 6, 2, "#000000")
+        >>> image.draw_line(-2, 3, 9, 3, "#000000")
+        >>> image.draw_line(6, 3, 6, 0, "#000000")
+        >>> show(image)
+        ##----#
+        --###-#
+        -----##
+        #######
+        >>> image.color_counts()["#000000"]
+        16
+        """
+        dx, dy = abs(x1 - x0), abs(y1 - y0)
+        step_x, step_y = (1 if x0 < x1 else -1), (1 if y0 < y1 else -1)
+        # Bresenham's line takes a step along the longer axis every time,
+        # and after i of them has taken (2 * minor * i + major) //
+        # (2 * major) steps along the other
+        if dx >= dy:
+            steps = _clip_steps(x0, step_x, dx, self.__width)
+            spans = []
+            for rows, run in itertools.groupby(
+                    steps, key=lambda i: (2 * dy * i + dx) // (2 * dx or 1)):
+                run = list(run)
+                ends = (x0 + step_x * run[0], x0 + step_x * run[-1])
+                spans.append((y0 + step_y * rows, min(ends), max(ends) + 1))
+            self.__fill_rows(spans, color)
+        else:
+            spans = []
+            for i in _clip_steps(y0, step_y, dy, self.__height):
+                x = x0 + step_x * ((2 * dx * i + dy) // (2 * dy))
+                spans.append((y0 + step_y * i, x, x + 1))
+            self.__fill_rows(spans, color)
+
+    def draw_circle(self, circle, color, fill=False):
+        """Draw a circle, such as a Shape.Circle, with the midpoint
+        algorithm
+
+        circle needs x, y and radius attributes. The outline, or with
+        fill=True the whole disc, is written as horizontal runs. Only the
+        rows inside the image are worked out, each directly.
 
-    def save(self, filename=None):
+        >>> def show(image):
+        ...     for y in range(image.height):
+        ...         print("".join("#" if image[x, y] == "#000000" else "-"
+        ...                       for x in range(image.width)))
+        >>> Circle = collections.namedtuple("Circle", "radius x y")
+        >>> image = Image(7, 7)
+        >>> image.draw_circle(Circle(2, 3, 3), "#000000")
+        >>> image.draw_circle(Circle(2, 6, 0), "#000000", fill=True)
+        >>> show(image)
+        ----###
+        --#####
+        -#---##
+        -#---#-
+        -#---#-
+        --###--
+        -------
+        """
+        cx, cy = int(round(circle.x)), int(round(circle.y))
+        radius = int(round(circle.radius))
+        if radius < 0:
+            return
+        squared = radius * radius
+
+        def column(y):
+            # The x the midpoint algorithm picks for row y of the octant
+            # from (radius, 0) to the diagonal: the largest x with
+            # x * x - x < radius ** 2 - y * y
+            if not y:
+                return radius
+            return (math.isqrt(4 * (squared - y * y)) + 1) // 2
+
+        # The octant's last row is the last one with x >= y
+        last = math.isqrt(squared // 2)
+        while last < radius and column(last + 1) >= last + 1:
+            last += 1
+        while column(last) < last:
+            last -= 1
+
+        def reach(x):
+            # The number of octant rows whose x is at least x
+            if x > radius:
+                return 0
+            if not x:
+                return last + 1
+            return min(last, math.isqrt(squared - x * x + x - 1)) + 1
+
+        spans = []
+        for dy in range(max(-radius, -cy),
+                        min(radius, self.__height - 1 - cy) + 1):
+            # The octant's (x, y) points mirror onto this row as the
+            # x of row abs(dy), and as the y of the rows whose x is abs(dy)
+            row = abs(dy)
+            xs = set(range(reach(row + 1), reach(row)))
+            if row <= last:
+                xs.add(column(row))
+            if not xs:
+                continue
+            if fill:
+                spans.append((cy + dy, cx - max(xs), cx + max(xs) + 1))
+                continue
+            xs = sorted(xs | {-x for x in xs})
+            start = xs[0]
+            for previous, x in zip(xs, xs[1:] + [None]):
+                if x != previous + 1:
+                    spans.append((cy + dy, cx + start, cx + previous + 1))
+                    start = x
+        self.__fill_rows(spans, color)
+
+    def flood_fill(self, x, y, color):
+        """Set the area of same-colored pixels connected to (x, y)
+
+        Scanline fill: each run of matching pixels is found in a row and
+        written with one fill, then the rows above and below are seeded
+        once per matching run.
+
+        >>> image = Image(5, 5)
+        >>> image.draw_line(0, 2, 4, 2, "#000000")
+        >>> image.draw_line(2, 0, 2, 1, "#000000")
+        >>> image.flood_fill(0, 0, "#FF0000")
+        >>> names = {"#FF0000": "r", "#000000": "#", "#FFFFFF": "-"}
+        >>> for y in range(image.height):
+        ...     print("".join(names[image[x, y]] for x in range(5)))
+        rr#--
+        rr#--
+        #####
+        -----
+        -----
+        >>> image.color_counts() == {"#FF0000": 4, "#000000": 7,
+        ...                          "#FFFFFF": 14}
+        True
+        """
+        x, y = self.__check((x, y))
+        target = self.__data.get(x, y)
+        if target == color:
+            return
+        self.__make_writable()
+        # Only the last few rows read are kept: seeds are mostly taken
+        # next to the row that pushed them
+        rows = collections.OrderedDict()
+
+        def row(y):
+            colors = rows.get(y)
+            if colors is None:
+                colors = rows[y] = self.__data.row(y, 0, self.__width)
+                if len(rows) > 4:
+                    rows.popitem(last=False)
+            else:
+                rows.move_to_end(y)
+            return colors
+
+        seeds = [(x, y)]
+        while seeds:
+            x, y = seeds.pop()
+            colors = row(y)
+            if colors[x] != target:
+                continue
+            left = right = x
+            while left > 0 and colors[left - 1] == target:
+                left -= 1
+            while right + 1 < self.__width and colors[right + 1] == target:
+                right += 1
+            colors[left:right + 1] = [color] * (right + 1 - left)
+            if color != self.__background:
+                self.__make_dense_if_full(right + 1 - left)
+            self.__data.fill(left, y, right + 1, y + 1, color)
+            for next_y in (y - 1, y + 1):
+                if not 0 <= next_y < self.__height:
+                    continue
+                colors = row(next_y)
+                i = left
+                while i <= right:
+                    if colors[i] == target:
+                        seeds.append((i, next_y))
+                        while i <= right and colors[i] == target:
+                            i += 1
+                    i += 1
+
+    def to_array(self):
+        """Return (indexes, palette): a height x width NumPy array of
+        palette indexes and the list of colors they refer to
+
+        For dense images the array is a read-only view of the image's
+        memory (until the palette outgrows the index size), and for
+        memory-mapped ones a view of the file where the rows are not
+        compressed; otherwise it is a copy.
+        """
+        import numpy
+
+        pixels = self.__data
+        if isinstance(pixels, _DensePixels):
+            palette = pixels.palette
+            indexes = numpy.frombuffer(pixels.data, pixels.data.typecode)
+            indexes.flags.writeable = False
+        elif isinstance(pixels, _MappedPixels) and not pixels.compressed:
+            palette = pixels.palette
+            indexes = numpy.frombuffer(
+                pixels.buffer, "<" + _TYPECODES[pixels.itemsize],
+                self.__width * self.__height, pixels.offset)
+        else:
+            palette, _, itemsize, rows = pixels.index_rows()
+            indexes = numpy.frombuffer(b"".join(rows), _TYPECODES[itemsize])
+        return indexes.reshape(self.__height, self.__width), list(palette)
+
+    @classmethod
+    def from_array(cls, indexes, palette, filename=""):
+        """Return a dense Image from a 2D array of indexes into palette
+
+        palette[0] becomes the background color.
+        """
+        import numpy
+
+        indexes = numpy.asarray(indexes)
+        if indexes.ndim != 2:
+            raise ValueError("indexes must be a 2D array")
+        if len(set(palette)) != len(palette) or not palette:
+            raise ValueError("palette colors must be unique")
+        if indexes.size and (indexes.min() < 0 or
+                             indexes.max() >= len(palette)):
+            raise ValueError("indexes must be valid palette indexes")
+        height, width = indexes.shape
+        image = cls(width, height, filename, palette[0], dense=True)
+        pixels = image.__data
+        for color in palette[1:]:
+            pixels.index(color)
+        pixels.data = array.array(pixels.typecode())
+        pixels.data.frombytes(memoryview(numpy.ascontiguousarray(
+            indexes, dtype=pixels.typecode())).cast("B"))
+        pixels.counts = numpy.bincount(indexes.ravel(),
+                                       minlength=len(palette)).tolist()
+        return image
+
+    def get_region(self, x, y, width, height):
+        """Return a new width x height Image copied from (x, y)
+
+        >>> image = Image(4, 3)
+        >>> image.fill_rect(1, 1, 2, 2, "#FF0000")
+        >>> region = image.get_region(1, 1, 3, 2)
+        >>> region.width, region.height, region[0, 0], region[2, 1]
+        (3, 2, '#FF0000', '#FFFFFF')
+        """
+        self.__check_region(x, y, width, height)
+        region = Image(width, height, background=self.__background,
+                       dense=self.__dense)
+        region.blit(self, 0, 0, x, y, width, height)
+        return region
+
+    def blit(self, source, x=0, y=0, source_x=0, source_y=0, width=None,
+             height=None):
+        """Copy a rectangle of the source Image to (x, y) in this one
+
+        By default the whole source image is copied. Pixels are copied a
+        row at a time, including the source's background pixels.
+
+        >>> image = Image(4, 3, dense=True)
+        >>> image.fill_rect(0, 0, 2, 1, "#FF0000")
+        >>> image.blit(image, 2, 1, 0, 0, 2, 1)
+        >>> [image[x, 1] for x in range(4)]
+        ['#FFFFFF', '#FFFFFF', '#FF0000', '#FF0000']
+        >>> source = Image(2, 2)
+        >>> image.blit(source, 1, 0)
+        >>> [image[x, 0] for x in range(4)], image.color_counts()["#FF0000"]
+        (['#FF0000', '#FFFFFF', '#FFFFFF', '#FFFFFF'], 2)
+        >>> image.blit(source, 3, 0)  # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        CoordinateError: (3, 0, 2, 2)
+        """
+        width = source.width - source_x if width is None else width
+        height = source.height - source_y if height is None else height
+        source.__check_region(source_x, source_y, width, height)
+        self.__check_region(x, y, width, height)
+        if not width or not height:
+            return
+        rows = (source.__data.row(source_y + row, source_x, source_x + width)
+                for row in range(height))
+        if source is self:
+            rows = list(rows)
+        self.__make_writable()
+        self.__make_dense_if_full(width * height)
+        for row, colors in enumerate(rows):
+            self.__data.put_row(x, y + row, colors)
+
+    def save(self, filename=None, compress=None):
+        """Save the image in the binary image format
+
+        With compress=True each row is compressed separately with zlib;
+        by default only sparse images, which are mostly background, are.
+        The file is written under a temporary name and then renamed, so
+        an image memory-mapped from the same file stays readable.
+
+        Tiled images are saved as tile files instead; saving to the file
+        they were loaded from or last saved to only writes the tiles
+        changed since.
+
+        >>> import tempfile
+        >>> filename = os.path.join(tempfile.gettempdir(), "doctest.imt")
+        >>> image = Image(256, 256, tiled=True)
+        >>> image.fill_rect(0, 0, 256, 256, "#000000")
+        >>> image.save(filename)
+        >>> size = os.path.getsize(filename)
+        >>> image[1, 1] = image[200, 200] = "#FF0000"
+        >>> image.save(filename)
+        >>> tiles = image._Image__data
+        >>> (os.path.getsize(filename) - size == tiles.stored[0, 0][1] +
+        ...  tiles.stored[3, 3][1] + tiles.stored_index)
+        True
+        >>> copy = Image(1, 1)
+        >>> copy.load(filename)
+        >>> copy[1, 1], copy[200, 200], copy[2, 2]
+        ('#FF0000', '#FF0000', '#000000')
+        >>> copy.color_counts() == image.color_counts() == {
+        ...     "#000000": 256 * 256 - 2, "#FF0000": 2}
+        True
+        >>> os.remove(filename)
+
+        Sparse images are compressed by default, so an image that is
+        mostly background stays small on disk
+        >>> filename = os.path.join(tempfile.gettempdir(), "doctest.img")
+        >>> image = Image(4000, 4000, dense=False)
+        >>> for i in range(50):
+        ...     image[i * 80, i * 80] = "#000000"
+        >>> image.save(filename)
+        >>> os.path.getsize(filename) < 4000 * 4000 // 100
+        True
+        >>> copy = Image(1, 1)
+        >>> copy.load(filename, mmap=True)
+        >>> copy[80, 80], copy[81, 80], copy.color_counts()["#000000"]
+        ('#000000', '#FFFFFF', 50)
+        >>> os.remove(filename)
+        """
         if filename is not None:
             self.filename = filename
         if not self.filename:
             raise NoFilenameError()
 
         fh = None
+        temporary = self.filename + ".tmp"
         try:
-            data = [self.width, self.height, self.__background, self.__data]
-            fh = open(self.filename, "wb")
-            pickle.dump(data, fh, pickle.HIGHEST_PROTOCOL)
-        except (EnvironmentError, pickle.PicklingError) as err:
+            if isinstance(self.__data, _TiledPixels):
+                self.__data.save(self.filename)
+                return
+            fh = open(temporary, "wb")
+            if compress is None:
+                compress = isinstance(self.__data, _SparsePixels)
+            _write_pixels(fh, self.__data, compress)
+            fh.close()
+            os.replace(temporary, self.filename)
+        except (EnvironmentError, zlib.error) as err:
             raise SaveError(err)
         finally:
             if fh is not None:
                 fh.close()
 
-    def load(self, filename=None):
+    def load(self, filename=None, mmap=False):
+        """Load an image or tile file saved by save(), or an image in the
+        older pickle format
+
+        With mmap=True a binary image file is memory-mapped and its rows
+        decoded only when accessed, so opening takes the same time for
+        any image size; the first change copies the pixels into memory.
+
+        >>> import tempfile
+        >>> filename = os.path.join(tempfile.gettempdir(), "doctest.img")
+        >>> image = Image(300, 2)
+        >>> for x in range(300):
+        ...     image[x, 1] = "#{0:06X}".format(x)
+        >>> for compress in (False, True):
+        ...     for mmap in (False, True):
+        ...         image.save(filename, compress)
+        ...         copy = Image(1, 1)
+        ...         copy.load(filename, mmap=mmap)
+        ...         print(copy.width, copy.height, copy[299, 1], copy[0, 0],
+        ...               copy.color_counts() == image.color_counts())
+        300 2 #00012B #FFFFFF True
+        300 2 #00012B #FFFFFF True
+        300 2 #00012B #FFFFFF True
+        300 2 #00012B #FFFFFF True
+        >>> copy[0, 0] = "#000000"
+        >>> copy[0, 0], copy.dense
+        ('#000000', True)
+
+        Indexes are stored little-endian whatever the machine
+        >>> image.save(filename)
+        >>> with open(filename, "rb") as fh:
+        ...     fh.read()[-2:] == (300).to_bytes(2, "little")
+        True
+
+        Images in the older pickle format still load
+        >>> with open(filename, "wb") as fh:
+        ...     pickle.dump((3, 2, "#FFFFFF", {(1, 1): "#000000"}), fh)
+        >>> image.load(filename)
+        >>> image.width, image.height, image[1, 1], image[0, 1]
+        (3, 2, '#000000', '#FFFFFF')
+        >>> os.remove(filename)
+        """
         if filename is not None:
             self.filename = filename
         if not self.filename:
@@ -104,16 +1432,83 @@ class Image:
         fh = None
         try:
             fh = open(self.filename, "rb")
-            data = pickle.load(fh)
-            (self.__width, self.__height, self.__background, self.__data) = data
-            self.__colors = (set(self.__data.values()) | {self.__background})
-        except (EnvironmentError, pickle.UnpicklingError) as err:
+            magic = fh.read(len(IMAGE_MAGIC))
+            fh.seek(0)
+            if magic == TILE_MAGIC:
+                pixels = _TiledPixels.open(fh, self.filename)
+            elif magic != IMAGE_MAGIC:
+                self.__load_pickle(fh)
+                return
+            else:
+                pixels = _MappedPixels.open(fh)
+            if not mmap and isinstance(pixels, _MappedPixels):
+                mapped, pixels = pixels, pixels.to_dense()
+                mapped.close()
+                if self.__dense is False:
+                    pixels = _SparsePixels(pixels.width, pixels.height,
+                                           pixels.background,
+                                           dict(pixels.items()))
+            self.__width, self.__height = pixels.width, pixels.height
+            self.__background = pixels.background
+            self.__data = pixels
+        except (EnvironmentError, pickle.UnpicklingError, ValueError,
+                IndexError, KeyError, OverflowError, struct.error,
+                zlib.error) as err:
             raise LoadError(err)
         finally:
             if fh is not None:
                 fh.close()
 
+    def __load_pickle(self, fh):
+        data = pickle.load(fh)
+        (self.__width, self.__height, self.__background, pixels) = data
+        self.__data = _SparsePixels(self.__width, self.__height,
+                                    self.__background, pixels)
+        self.__make_dense_if_full()
+
     def export(self, filename):
+        """Export the image; only XPM (.xpm) is supported
+
+        >>> import tempfile
+        >>> directory = tempfile.mkdtemp()
+        >>> filename = os.path.join(directory, "1st café.xpm")
+        >>> image = Image(3, 2)
+        >>> image[1, 0] = image[2, 1] = "#FF0000"
+        >>> image.export(filename)
+        >>> with open(filename) as fh:
+        ...     print(fh.read(), end="")
+        /* XPM */
+        static char *_1st_caf_[] = {
+        /* columns rows colors chars-per-pixel */
+        "3 2 2 1",
+        "a c #FF0000",
+        "b c #FFFFFF",
+        /* pixels */
+        "bab",
+        "bba"
+        };
+
+        With more colors than XPM_CHARS each pixel takes two characters
+        >>> image = Image(len(XPM_CHARS) + 1, 1)
+        >>> for x in range(len(XPM_CHARS)):
+        ...     image[x, 0] = "#{0:06X}".format(x)
+        >>> image.export(filename)
+        >>> with open(filename) as fh:
+        ...     lines = fh.read().splitlines()
+        >>> lines[3], lines[4], lines[-4]
+        ('"94 1 94 2",', '"aa c #000000",', '"ba c #FFFFFF",')
+        >>> row = lines[-2]
+        >>> row[:7], row[-5:], len(row) == 2 + 2 * image.width
+        ('"aaabac', 'a ba"', True)
+        >>> image[0, 0] = "#FFFFFFé"
+        >>> image.export(filename)  # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        ExportError: 'ascii' codec can't encode character
+        >>> for name in os.listdir(directory):
+        ...     os.remove(os.path.join(directory, name))
+        >>> os.rmdir(directory)
+        """
         if filename.lower().endswith(".xpm"):
             self.__export_xpm(filename)
         else:
@@ -121,4 +1516,81 @@ class Image:
                               os.path.splitext(filename)[1])
 
     def __export_xpm(self, filename):
-        raise NotImplementedError()
+        """Write the image as XPM one row at a time
+
+        Each color gets its code once; rows are then encoded and written
+        through the file's buffer, so memory use is bounded by one row.
+        """
+        name = os.path.splitext(os.path.basename(filename))[0]
+        name = re.sub(r"\W", "_", name, flags=re.ASCII) or "image"
+        if name[0].isdigit():
+            name = "_" + name
+        colors = sorted(self.colors)
+        per_pixel = 1
+        while len(XPM_CHARS) ** per_pixel < len(colors):
+            per_pixel += 1
+        codes = dict(zip(colors, map("".join, itertools.product(
+            XPM_CHARS, repeat=per_pixel))))
+
+        fh = None
+        try:
+            fh = open(filename, "w", encoding="ascii", buffering=1 << 16)
+            fh.write("/* XPM */\nstatic char *{0}[] = {{\n".format(name))
+            fh.write("/* columns rows colors chars-per-pixel */\n")
+            fh.write('"{0} {1} {2} {3}",\n'.format(
+                self.__width, self.__height, len(colors), per_pixel))
+            for color in colors:
+                fh.write('"{0} c {1}",\n'.format(codes[color], color))
+            fh.write("/* pixels */\n")
+            for y in range(self.__height):
+                row = self.__data.row(y, 0, self.__width)
+                fh.write('"{0}"{1}\n'.format(
+                    "".join(map(codes.__getitem__, row)),
+                    "," if y + 1 < self.__height else ""))
+            fh.write("};\n")
+        except (EnvironmentError, UnicodeError) as err:
+            raise ExportError(err)
+        finally:
+            if fh is not None:
+                fh.close()
+
+
+# NumPy is optional, so its doctests only run where it is installed
+if importlib.util.find_spec("numpy") is not None:
+    __test__ = {"numpy": """
+    to_array() views a dense image's memory and copies other storages
+    >>> image = Image(3, 2, dense=True)
+    >>> image[1, 0] = image[2, 1] = "#FF0000"
+    >>> indexes, palette = image.to_array()
+    >>> indexes.tolist(), palette, indexes.dtype.name
+    ([[0, 1, 0], [0, 0, 1]], ['#FFFFFF', '#FF0000'], 'uint8')
+    >>> indexes.flags.writeable
+    False
+    >>> sparse = Image(3, 2, dense=False)
+    >>> sparse[1, 0] = "#FF0000"
+    >>> sparse.to_array()[0].tolist()
+    [[0, 1, 0], [0, 0, 0]]
+
+    from_array() reverses it, widening the indexes for large palettes
+    >>> copy = Image.from_array(indexes, palette)
+    >>> copy.dense, copy.width, copy.height, copy[1, 0], copy[2, 1]
+    (True, 3, 2, '#FF0000', '#FF0000')
+    >>> copy.color_counts() == image.color_counts()
+    True
+    >>> import numpy
+    >>> colors = ["#{0:06X}".format(i) for i in range(300)]
+    >>> wide = Image.from_array(numpy.arange(600).reshape(2, 300) % 300,
+    ...                         colors)
+    >>> wide[299, 1], wide.to_array()[0].dtype.name
+    ('#00012B', 'uint16')
+    >>> Image.from_array([[0, 2]], ["#FFFFFF", "#000000"])
+    Traceback (most recent call last):
+    ...
+    ValueError: indexes must be valid palette indexes
+    """}
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
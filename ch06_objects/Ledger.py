@@ -0,0 +1,189 @@
+import collections
+import concurrent.futures
+import glob
+import heapq
+import math
+import os
+
+from ch06_objects import Account
+
+# What a ledger remembers about an account without holding its transactions
+Summary = collections.namedtuple(
+    'Summary', 'number name balance non_usd transactions')
+
+
+def _summarize(account):
+    return Summary(account.number, account.name, account.balance,
+                   account.non_usd, len(account))
+
+
+def _load(filename, keep=True):
+    account = Account.Account(0, 'loading')
+    account.load(filename)
+    return account.filename, account if keep else None, _summarize(account)
+
+
+def _load_summary(filename):
+    return _load(filename, keep=False)
+
+
+class Ledger:
+    """Ledger manages the .acc files of many Accounts in one directory
+
+    load() spreads the work over a pool of processes. Aggregate
+    queries use a per-account Summary, so they do not need the accounts'
+    transactions; load(accounts=False) keeps only the summaries and
+    ledger[number] then loads an account on first access.
+
+    >>> import tempfile
+    >>> from datetime import datetime
+    >>> directory = tempfile.mkdtemp(suffix='[ledger]')
+    >>> ledger = Ledger(directory, processes=2)
+    >>> for number in range(1, 6):
+    ...     account = Account.Account(number, 'account {0}'.format(number))
+    ...     account.apply(Account.Transaction(100 * number, datetime(2019, 5, 19)))
+    ...     ledger.add(account)
+    >>> ledger[2].apply(Account.Transaction(6250, datetime(2019, 5, 20), currency='RUB', usd_conversion_rate=62.5))
+    >>> account = Account.Account(6, 'account 6')
+    >>> account.filename = os.path.join(directory, 'six')
+    >>> ledger.add(account)
+    >>> ledger.save()
+    >>> os.path.basename(ledger[6].filename)
+    'six.acc'
+
+    >>> ledger = Ledger(directory, processes=2)
+    >>> ledger.load(accounts=False)
+    >>> len(ledger), ledger.total_usd()
+    (6, 1600.0)
+    >>> [(s.number, s.balance) for s in ledger.top(2)]
+    [(5, 500.0), (4, 400.0)]
+    >>> [s.number for s in ledger.non_usd()]
+    [2]
+    >>> ledger[3].apply(Account.Transaction(-300, datetime(2019, 5, 21)))
+    >>> ledger.summary(3).balance, ledger.total_usd()
+    (0.0, 1300.0)
+
+    >>> Account.Account(4, 'copy of 4').save(os.path.join(directory, 'copy'))
+    >>> ledger.load()  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ch06_objects.Account.LoadError: account 4 is in both .../4.acc and .../copy.acc
+    >>> len(ledger)
+    6
+
+    >>> for filename in os.listdir(directory):
+    ...     os.remove(os.path.join(directory, filename))
+    >>> os.rmdir(directory)
+    """
+
+    def __init__(self, directory, processes=None):
+        self.directory = directory
+        self.processes = processes
+        self.__accounts = {}
+        self.__filenames = {}
+        self.__summaries = {}
+
+    def add(self, account):
+        if account.filename is None:
+            account.filename = os.path.join(self.directory,
+                                            '{0}.acc'.format(account.number))
+        self.__accounts[account.number] = account
+        self.__filenames[account.number] = account.filename
+        self.__summaries.pop(account.number, None)
+
+    def __getitem__(self, number):
+        account = self.__accounts.get(number)
+        if account is None:
+            filename = self.__filenames[number]
+            _, account, _ = _load(filename)
+            self.__accounts[number] = account
+        return account
+
+    def __contains__(self, number):
+        return number in self.__filenames
+
+    def __len__(self):
+        return len(self.__filenames)
+
+    def __iter__(self):
+        return iter(sorted(self.__filenames))
+
+    def __map(self, function, items):
+        workers = self.processes or os.cpu_count() or 1
+        if workers == 1 or len(items) < 2:
+            yield from map(function, items)
+            return
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            yield from pool.map(function, items, chunksize=max(
+                1, len(items) // (workers * 4)))
+
+    def load(self, accounts=True):
+        """Load every .acc file in the directory
+
+        With accounts=False only the summaries are kept. Two files
+        holding the same account number raise Account.LoadError, and the
+        ledger is left as it was.
+        """
+        pattern = os.path.join(glob.escape(self.directory), '*.acc')
+        filenames = sorted(glob.glob(pattern))
+        loaded, found, summaries = {}, {}, {}
+        for filename, account, summary in self.__map(
+                _load if accounts else _load_summary, filenames):
+            if summary.number in found:
+                raise Account.LoadError(
+                    'account {0} is in both {1} and {2}'.format(
+                        summary.number, found[summary.number], filename))
+            found[summary.number] = filename
+            summaries[summary.number] = summary
+            if account is not None:
+                account.filename = filename
+                loaded[summary.number] = account
+        self.__accounts, self.__filenames = loaded, found
+        self.__summaries = summaries
+
+    def save(self):
+        """Save every loaded account to its .acc file
+
+        Saving stays in this process: a worker would need the
+        transactions pickled to it, which costs as much as pickling them
+        to the file, and the accounts' filenames and journal state have
+        to change here anyway.
+        """
+        for number, account in self.__accounts.items():
+            account.save()
+            self.__filenames[number] = account.filename
+
+    def summary(self, number):
+        """Return the Summary of an account
+
+        Summaries of loaded accounts are read from the account itself, so
+        they follow its transactions.
+        """
+        account = self.__accounts.get(number)
+        if account is not None:
+            return _summarize(account)
+        summary = self.__summaries.get(number)
+        if summary is None:
+            summary = self.__summaries[number] = _summarize(self[number])
+        return summary
+
+    def summaries(self):
+        return (self.summary(number) for number in self)
+
+    def total_usd(self):
+        return math.fsum(summary.balance for summary in self.summaries())
+
+    def top(self, n):
+        """Return the Summaries of the n accounts with the largest balance"""
+        return heapq.nlargest(n, self.summaries(),
+                              key=lambda summary: summary.balance)
+
+    def non_usd(self):
+        """Return the Summaries of accounts holding non-USD transactions"""
+        return [summary for summary in self.summaries() if summary.non_usd]
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -1,8 +1,82 @@
-from typing import Optional, _KT, _VT, overload, Union, _T, Tuple, ValuesView
+from collections.abc import ItemsView, KeysView, ValuesView
 
 from ch06_objects import SortedList
 
 
+class _SortedView:
+    """Lazy view of a SortedDict in key order
+
+    Besides len() and membership, views support positional access
+    (view[i], view[i:j]) and key range iteration, all served from the
+    sorted keys without copying the dictionary.
+    """
+
+    def __init__(self, mapping, keys):
+        super().__init__(mapping)
+        self._keys = keys
+
+    def _items(self, keys):
+        # What the view yields for the given keys; the keys view yields
+        # the keys themselves
+        return iter(keys)
+
+    def __iter__(self):
+        return self._items(iter(self._keys))
+
+    def __reversed__(self):
+        return self._items(reversed(self._keys))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self._items(self._keys[index]))
+        return next(self._items((self._keys[index],)))
+
+    def irange(self, minimum=None, maximum=None, inclusive=(True, True),
+               reverse=False):
+        return self._items(self._keys.irange(minimum, maximum, inclusive,
+                                             reverse))
+
+    def islice(self, start=None, stop=None, reverse=False):
+        return self._items(self._keys.islice(start, stop, reverse))
+
+    def __repr__(self):
+        return "{0}({1!r})".format(self.__class__.__name__, list(self))
+
+
+class SortedKeysView(_SortedView, KeysView):
+    """
+    >>> d = SortedDict(b=2, c=3, a=1, d=4)
+    >>> keys = d.keys()
+    >>> len(keys), "c" in keys, keys[0], keys[1:3]
+    (4, True, 'a', ['b', 'c'])
+    >>> list(keys.irange("b", "c"))
+    ['b', 'c']
+    """
+
+
+class SortedValuesView(_SortedView, ValuesView):
+    """
+    >>> d = SortedDict(b=2, c=3, a=1, d=4)
+    >>> d.values()[-1], list(d.values().irange("c"))
+    (4, [3, 4])
+    """
+
+    def _items(self, keys):
+        return map(self._mapping.__getitem__, keys)
+
+
+class SortedItemsView(_SortedView, ItemsView):
+    """
+    >>> d = SortedDict(b=2, c=3, a=1, d=4)
+    >>> d.items()[:2], ("a", 1) in d.items()
+    ([('a', 1), ('b', 2)], True)
+    """
+
+    def _items(self, keys):
+        mapping = self._mapping
+        return ((key, mapping[key]) for key in keys)
+
+
 class SortedDict(dict):
 
     def __init__(self, dictionary=None, key=None, **kwargs):
@@ -13,17 +87,60 @@ class SortedDict(dict):
         self.__keys = SortedList.SortedList(super().keys(), key)
 
     def update(self, dictionary=None, **kwargs):
+        """
+        >>> d = SortedDict(d=4, b=2)
+        >>> d.update({'c': 3, 'b': 20, 'a': 1}, e=5, d=40, f=6)
+        >>> list(d), [d.keys()[i] for i in range(len(d))]
+        (['a', 'b', 'c', 'd', 'e', 'f'], ['a', 'b', 'c', 'd', 'e', 'f'])
+        >>> d['b'], d['d'], len(d.keys())
+        (20, 40, 6)
+        >>> from types import MappingProxyType
+        >>> d.update(MappingProxyType({'a': 10, 'aa': 0}), aa=1)
+        >>> list(d.items())[:3]
+        [('a', 10), ('aa', 1), ('b', 20)]
+        >>> d.keys()[1], d.keys()[-1], len(d.keys())
+        ('aa', 'f', 7)
+        """
+        # Only keys that are not in the dictionary yet go into the sorted
+        # keys, so small updates of a large dictionary stay cheap
+        new_keys = {}
         if dictionary is None:
             pass
         elif isinstance(dictionary, dict):
+            new_keys.update((key, None) for key in dictionary
+                            if key not in self)
             super().update(dictionary)
         else:
             for key, value in dictionary.items():
+                if key not in self:
+                    new_keys[key] = None
                 super().__setitem__(key, value)
         if kwargs:
+            new_keys.update((key, None) for key in kwargs if key not in self)
             super().update(kwargs)
-        self.__keys = SortedList.SortedList(super().keys(),
-                                            self.__keys.key)
+        self.__keys.update(new_keys)
+
+    def __reduce__(self):
+        """
+        >>> import pickle
+        >>> d = pickle.loads(pickle.dumps(SortedDict(b=2, c=3, a=1)))
+        >>> d, d.peekitem(0)
+        ({'a': 1, 'b': 2, 'c': 3}, ('a', 1))
+        >>> d = SortedDict({'b': 2, 'A': 1, 'c': 3}, key=str.lower)
+        >>> d = pickle.loads(pickle.dumps(d))
+        >>> d['a0'] = 0
+        >>> type(d).__name__, list(d)
+        ('SortedDict', ['A', 'a0', 'b', 'c'])
+        """
+        # dict's default pickling re-adds every item with __setitem__;
+        # instead restore the already sorted keys and the values in
+        # key order in one go
+        return self.__class__, (), (self.__keys, list(self.values()))
+
+    def __setstate__(self, state):
+        keys, values = state
+        super().update(zip(keys, values))
+        self.__keys = keys
 
     @classmethod
     def fromkeys(cls, iterable, value=None, key=None):
@@ -54,27 +171,47 @@ class SortedDict(dict):
         self.__keys.remove(key)
         return super().pop(key, args)
 
-    def popitem(self):
-        item = super().popitem()
-        self.__keys.remove(item[0])
-        return item
+    def popitem(self, index=-1):
+        """Remove and return the (key, value) pair at the given position
+        in key order; by default the one with the largest key
+
+        >>> d = SortedDict(b=2, c=3, a=1)
+        >>> d.popitem(), d.popitem(0), d
+        (('c', 3), ('a', 1), {'b': 2})
+        """
+        if not self:
+            raise KeyError("popitem(): dictionary is empty")
+        key = self.__keys.pop(index)
+        return key, super().pop(key)
+
+    def peekitem(self, index=-1):
+        """Return the (key, value) pair at the given position in key order
+
+        >>> d = SortedDict(b=2, c=3, a=1)
+        >>> d.peekitem(), d.peekitem(0)
+        (('c', 3), ('a', 1))
+        """
+        key = self.__keys[index]
+        return key, self[key]
 
     def clear(self):
         super().clear()
         self.__keys.clear()
 
+    def keys(self):
+        return SortedKeysView(self, self.__keys)
+
     def values(self):
-        for key in self.__keys:
-            yield self[key]
+        return SortedValuesView(self, self.__keys)
 
     def items(self):
-        for key in self.__keys:
-            yield (key, self[key])
+        return SortedItemsView(self, self.__keys)
 
     def __iter__(self):
         return iter(self.__keys)
 
-    keys = __iter__
+    def __reversed__(self):
+        return reversed(self.__keys)
 
     def __repr__(self):
         return super().__repr__()
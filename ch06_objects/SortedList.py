@@ -1,99 +1,544 @@
+import bisect
+import heapq
+import itertools
+import operator
+
 _identity = lambda x: x
 
+# Sublists are split once they grow past twice the load and merged with a
+# neighbour once they shrink below half of it
+DEFAULT_LOAD = 1000
+
 
 class SortedList:
-    def __init__(self, sequence=None, key=None):
+    def __init__(self, sequence=None, key=None, load=DEFAULT_LOAD):
+        """A list kept in key order
+
+        Values are stored in sorted sublists of roughly load items each, so
+        add() and remove() only move the tail of one sublist. load=None
+        selects the flat mode, where everything lives in a single list;
+        that is the faster choice for small lists.
+
+        >>> seq = SortedList(range(12), load=4)
+        >>> seq._SortedList__lists
+        [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9, 10, 11]]
+
+        A sublist that grows past twice the load is split in half
+        >>> for value in (4.1, 4.2, 4.3, 4.4, 4.5):
+        ...     seq.add(value)
+        >>> seq._SortedList__lists[1:3]
+        [[4, 4.1, 4.2, 4.3], [4.4, 4.5, 5, 6, 7]]
+
+        Deletions across sublists, and a sublist that shrinks below half
+        the load is merged into its neighbour
+        >>> del seq[3:11]
+        >>> seq._SortedList__lists
+        [[0, 1, 2], [6, 7], [8, 9, 10, 11]]
+        >>> del seq[3]
+        >>> seq._SortedList__lists
+        [[0, 1, 2, 7], [8, 9, 10, 11]]
+        >>> del seq[3]
+
+        Positions at sublist boundaries
+        >>> seq[2], seq[3], seq[-1], len(seq)
+        (2, 8, 11, 7)
+        >>> seq.pop(2), seq.pop(2), seq.pop()
+        (2, 8, 11)
+        >>> seq._SortedList__lists
+        [[0, 1], [9, 10]]
+        >>> list(seq), seq.pop(0), seq.pop(0), seq.pop(0), seq.pop(0)
+        ([0, 1, 9, 10], 0, 1, 9, 10)
+        >>> seq.pop()
+        Traceback (most recent call last):
+        ...
+        IndexError: pop from empty SortedList
+        """
         self.__key = key or _identity
         assert hasattr(self.__key, "__call__")
+        assert load is None or load > 0, "load must be positive or None"
+        self.__load = load
         if sequence is None:
-            self.__list = []
+            self.__reset([], [])
         elif (isinstance(sequence, SortedList)
               and sequence.key == self.__key):
-            self.__list = sequence.__list[:]
+            self.__reset(list(sequence), sequence.__all_keys())
         else:
-            self.__list = sorted(list(sequence), key=self.__key)
+            self.__reset(*self.__sort(list(sequence)))
+
+    def __sort(self, values, keys=None):
+        # Return values and their keys sorted by key, calling the key
+        # function only for values whose key is not given
+        if keys is None:
+            keys = [self.__key(value) for value in values]
+        order = sorted(range(len(values)), key=keys.__getitem__)
+        return [values[i] for i in order], [keys[i] for i in order]
+
+    def __reset(self, values, keys):
+        # values must already be sorted and keys[i] == self.__key(values[i])
+        size = self.__load or len(values) or 1
+        self.__lists = [values[i:i + size]
+                        for i in range(0, len(values), size)]
+        # self.__keys[p][i] is always self.__key(self.__lists[p][i]), so
+        # the key function is called once per lookup instead of per probe
+        self.__keys = [keys[i:i + size] for i in range(0, len(keys), size)]
+        self.__maxes = [sublist[-1] for sublist in self.__keys]
+        self.__len = len(values)
+        self.__index = None
+
+    def __getstate__(self):
+        """
+        >>> import pickle
+        >>> seq = pickle.loads(pickle.dumps(SortedList([3, 1, 2], load=2)))
+        >>> list(seq), seq.load, seq.key is _identity
+        ([1, 2, 3], 2, True)
+        >>> seq.add(0); list(seq)
+        [0, 1, 2, 3]
+        >>> seq = SortedList(['b', 'A', 'c', 'a'], key=str.lower, load=2)
+        >>> seq = pickle.loads(pickle.dumps(seq))
+        >>> list(seq), seq.key is str.lower, seq.count('a')
+        (['A', 'a', 'b', 'c'], True, 1)
+        """
+        # Pickle the sorted sublists as they are, so loading is a linear
+        # copy instead of a sort; the identity key is rebuilt on load
+        identity = self.__key is _identity
+        return {"key": None if identity else self.__key,
+                "load": self.__load,
+                "lists": self.__lists,
+                "keys": None if identity else self.__keys}
+
+    def __setstate__(self, state):
+        self.__key = state["key"] or _identity
+        self.__load = state["load"]
+        self.__lists = state["lists"]
+        self.__keys = state["keys"]
+        if self.__keys is None:
+            self.__keys = [sublist[:] for sublist in self.__lists]
+        self.__maxes = [sublist[-1] for sublist in self.__keys]
+        self.__len = sum(map(len, self.__lists))
+        self.__index = None
+
+    def __all_keys(self):
+        return list(itertools.chain.from_iterable(self.__keys))
 
     @property
     def key(self):
         return self.__key
 
+    @property
+    def load(self):
+        return self.__load
+
+    def __offsets(self):
+        # Positional index: self.__offsets()[p] is the position of the
+        # first value of sublist p; rebuilt lazily after any change
+        if self.__index is None:
+            self.__index = list(itertools.accumulate(
+                map(len, self.__lists), initial=0))
+        return self.__index
+
+    def __locate_left(self, key):
+        # Return (sublist, offset) of the first value whose key is >= key
+        pos = bisect.bisect_left(self.__maxes, key)
+        if pos == len(self.__maxes):
+            return pos, 0
+        return pos, bisect.bisect_left(self.__keys[pos], key)
+
+    def __locate_right(self, key):
+        # Return (sublist, offset) of the first value whose key is > key
+        pos = bisect.bisect_right(self.__maxes, key)
+        if pos == len(self.__maxes):
+            return pos, 0
+        return pos, bisect.bisect_right(self.__keys[pos], key)
+
+    def __position(self, index):
+        # Return (sublist, offset) of the value at the given list index
+        if index < 0:
+            index += self.__len
+        if not 0 <= index < self.__len:
+            raise IndexError("{0} index out of range".format(
+                self.__class__.__name__
+            ))
+        if index < len(self.__lists[0]):
+            return 0, index
+        last = self.__len - len(self.__lists[-1])
+        if index >= last:
+            return len(self.__lists) - 1, index - last
+        offsets = self.__offsets()
+        pos = bisect.bisect_right(offsets, index) - 1
+        return pos, index - offsets[pos]
+
     def add(self, value):
-        index = self.__bisect_left(value)
-        if index == len(self.__list):
-            self.__list.append(value)
+        key = self.__key(value)
+        self.__index = None
+        self.__len += 1
+        if not self.__maxes:
+            self.__lists.append([value])
+            self.__keys.append([key])
+            self.__maxes.append(key)
+            return
+        pos = bisect.bisect_left(self.__maxes, key)
+        if pos == len(self.__maxes):
+            pos -= 1
+            self.__lists[pos].append(value)
+            self.__keys[pos].append(key)
+            self.__maxes[pos] = key
+        else:
+            index = bisect.bisect_left(self.__keys[pos], key)
+            self.__lists[pos].insert(index, value)
+            self.__keys[pos].insert(index, key)
+        self.__expand(pos)
+
+    def update(self, iterable):
+        """Add every value from iterable
+
+        The batch is sorted once; small batches are then added one by one
+        (each add only touches one sublist), while batches of at least a
+        quarter of the list are merged with the existing values and the
+        sublists rebuilt. Sorting the concatenation of two sorted runs is
+        a linear merge for Python's sort.
+
+        >>> seq = SortedList(range(0, 24, 2), load=4)
+        >>> seq.update([5, 3])
+        >>> seq._SortedList__lists
+        [[0, 2, 3, 4, 5, 6], [8, 10, 12, 14], [16, 18, 20, 22]]
+
+        A batch of a quarter of the list or more rebuilds the sublists
+        >>> seq.update([11, 1, 9, 7])
+        >>> seq._SortedList__lists[:3]
+        [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9, 10, 11]]
+        >>> seq.update([])
+        >>> len(seq)
+        18
+        """
+        values, keys = self.__sort(list(iterable))
+        if not values:
+            return
+        if len(values) * 4 >= self.__len:
+            self.__reset(*self.__sort(list(self) + values,
+                                      self.__all_keys() + keys))
+            return
+        for value in values:
+            self.add(value)
+
+    @classmethod
+    def merge(cls, *sorted_lists):
+        """Return a new SortedList holding the values of all sorted_lists
+
+        All the lists must share the same key; they are merged k-way on
+        their cached keys without calling the key function or re-sorting.
+        Values with equal keys keep the order of the lists they came from.
+
+        >>> merged = SortedList.merge(SortedList([3, 1, 2], load=4),
+        ...                           SortedList([2, 5]))
+        >>> list(merged), merged.load
+        ([1, 2, 2, 3, 5], 4)
+        >>> list(SortedList.merge(SortedList(['b', 'A'], key=str.lower),
+        ...                       SortedList(['a', 'C'], key=str.lower)))
+        ['A', 'a', 'b', 'C']
+        >>> list(SortedList.merge())
+        []
+        >>> SortedList.merge(SortedList([1]), SortedList(['a'], key=str.lower))
+        Traceback (most recent call last):
+        ...
+        ValueError: SortedList.merge(): lists must share the same key
+        """
+        if not sorted_lists:
+            return cls()
+        key = sorted_lists[0].key
+        if any(sorted_list.key != key for sorted_list in sorted_lists):
+            raise ValueError("{0}.merge(): lists must share the same key"
+                             .format(cls.__name__))
+        pairs = heapq.merge(*[zip(sorted_list.__all_keys(), sorted_list)
+                              for sorted_list in sorted_lists],
+                            key=operator.itemgetter(0))
+        keys, values = [], []
+        for item_key, value in pairs:
+            keys.append(item_key)
+            values.append(value)
+        merged = cls(key=key, load=sorted_lists[0].load)
+        merged.__reset(values, keys)
+        return merged
+
+    def __expand(self, pos):
+        if self.__load is None or len(self.__keys[pos]) <= 2 * self.__load:
+            return
+        half = len(self.__keys[pos]) // 2
+        self.__lists.insert(pos + 1, self.__lists[pos][half:])
+        self.__keys.insert(pos + 1, self.__keys[pos][half:])
+        del self.__lists[pos][half:]
+        del self.__keys[pos][half:]
+        self.__maxes.insert(pos, self.__keys[pos][-1])
+        self.__index = None
+
+    def __fix(self, pos):
+        # Restore the invariants of sublist pos after values were deleted
+        self.__index = None
+        if not self.__keys[pos]:
+            del self.__lists[pos]
+            del self.__keys[pos]
+            del self.__maxes[pos]
+            return
+        self.__maxes[pos] = self.__keys[pos][-1]
+        if (self.__load is None or len(self.__lists) == 1 or
+                len(self.__keys[pos]) >= self.__load // 2):
+            return
+        if pos == 0:
+            pos = 1
+        self.__lists[pos - 1].extend(self.__lists[pos])
+        self.__keys[pos - 1].extend(self.__keys[pos])
+        self.__maxes[pos - 1] = self.__keys[pos - 1][-1]
+        del self.__lists[pos]
+        del self.__keys[pos]
+        del self.__maxes[pos]
+        self.__expand(pos - 1)
+
+    def __delete(self, pos, index):
+        value = self.__lists[pos].pop(index)
+        del self.__keys[pos][index]
+        self.__len -= 1
+        self.__fix(pos)
+        return value
+
+    def __delete_range(self, start, stop):
+        # Delete list positions start <= i < stop with slice deletions
+        if start >= stop:
+            return
+        offsets = self.__offsets()
+        first = bisect.bisect_right(offsets, start) - 1
+        last = bisect.bisect_right(offsets, stop - 1) - 1
+        begin, end = start - offsets[first], stop - offsets[last]
+        if first == last:
+            del self.__lists[first][begin:end]
+            del self.__keys[first][begin:end]
         else:
-            self.__list.insert(index, value)
+            del self.__lists[first][begin:]
+            del self.__keys[first][begin:]
+            del self.__lists[last][:end]
+            del self.__keys[last][:end]
+            del self.__lists[first + 1:last]
+            del self.__keys[first + 1:last]
+            del self.__maxes[first + 1:last]
+            self.__fix(first + 1)
+        self.__len -= stop - start
+        self.__fix(first)
 
-    def __bisect_left(self, value):
+    def __find(self, value):
+        # Return (sublist, offset) of the first value equal to value, or
+        # None; with a key function, values with equal keys need not be
+        # equal, so every value with the same key is checked
         key = self.__key(value)
-        left, right = 0, len(self.__list)
-        while left < right:
-            middle = (left + right) // 2
-            if self.__key(self.__list[middle]) < key:
-                left = middle + 1
-            else:
-                right = middle
-        return left
+        pos, index = self.__locate_left(key)
+        while pos < len(self.__lists):
+            keys = self.__keys[pos]
+            while index < len(keys):
+                if keys[index] != key:
+                    return None
+                if self.__lists[pos][index] == value:
+                    return pos, index
+                if self.__key is _identity:
+                    return None
+                index += 1
+            pos, index = pos + 1, 0
+        return None
 
     def remove(self, value):
-        index = self.__bisect_left(value)
-        if index < len(self.__list) and self.__list[index] == value:
-            del self.__list[index]
-        else:
+        location = self.__find(value)
+        if location is None:
             raise ValueError("{0}.remove(x): x not in list".format(
                 self.__class__.__name__
             ))
+        self.__delete(*location)
 
     def remove_every(self, value):
-        count = 0
-        index = self.__bisect_left(value)
-        while (index < len(self.__list) and
-               self.__list[index] == value):
-            del self.__list[index]
-            count += 1
-        return count
+        """Remove every value equal to value and return how many there were
+
+        With a key function only values that compare equal are removed;
+        the others with the same key keep their order.
+
+        >>> seq = SortedList(['ab', 'x', 'cd', 'ab', 'ef', 'ab'], key=len,
+        ...                  load=2)
+        >>> seq.count('ab'), seq.count('cd'), seq.count('gh')
+        (3, 1, 0)
+        >>> seq.remove_every('ab'), list(seq)
+        (3, ['x', 'cd', 'ef'])
+        >>> seq.remove_every('ab')
+        0
+        >>> seq = SortedList([3, 1, 3, 2, 3], load=2)
+        >>> seq.count(3), seq.remove_every(3), list(seq)
+        (3, 3, [1, 2])
+        """
+        key = self.__key(value)
+        start, stop = self.bisect_key_left(key), self.bisect_key_right(key)
+        if self.__key is _identity:
+            self.__delete_range(start, stop)
+            return stop - start
+        same_key = list(self.islice(start, stop))
+        kept = [item for item in same_key if item != value]
+        if len(kept) < len(same_key):
+            self.__delete_range(start, stop)
+            # add() inserts before equal keys, so re-adding in reverse
+            # keeps the original order of the survivors
+            for item in reversed(kept):
+                self.add(item)
+        return len(same_key) - len(kept)
 
     def count(self, value):
-        count = 0
-        index = self.__bisect_left(value)
-        while (index < len(self.__list) and
-               self.__list[index] == value):
-            index += 1
-            count += 1
-        return count
+        key = self.__key(value)
+        start, stop = self.__locate_left(key), self.__locate_right(key)
+        if self.__key is _identity:
+            (first, begin), (last, end) = start, stop
+            if first == last:
+                return end - begin
+            offsets = self.__offsets()
+            return offsets[last] + end - offsets[first] - begin
+        return sum(1 for item in self.__slice(start, stop) if item == value)
+
+    def bisect_key_left(self, key):
+        """Return the index where a value with the given key would be
+        inserted before any values with an equal key"""
+        pos, index = self.__locate_left(key)
+        return self.__offsets()[pos] + index
+
+    def bisect_key_right(self, key):
+        """Return the index where a value with the given key would be
+        inserted after any values with an equal key"""
+        pos, index = self.__locate_right(key)
+        return self.__offsets()[pos] + index
+
+    def bisect_left(self, value):
+        return self.bisect_key_left(self.__key(value))
+
+    def bisect_right(self, value):
+        return self.bisect_key_right(self.__key(value))
+
+    def irange(self, minimum=None, maximum=None, inclusive=(True, True),
+               reverse=False):
+        """Return an iterator over the values between minimum and maximum
 
-    def __del__(self, index):
-        del self.__list[index]
+        The bounds are compared by key; None means unbounded and inclusive
+        says whether each bound is included. Values are streamed from the
+        storage without copying.
+
+        >>> seq = SortedList([5, 1, 4, 2, 3], load=2)
+        >>> list(seq.irange(2, 4))
+        [2, 3, 4]
+        >>> list(seq.irange(2, 4, inclusive=(False, True), reverse=True))
+        [4, 3]
+        """
+        return self.irange_key(
+            None if minimum is None else self.__key(minimum),
+            None if maximum is None else self.__key(maximum),
+            inclusive, reverse)
+
+    def irange_key(self, minimum=None, maximum=None, inclusive=(True, True),
+                   reverse=False):
+        """Return an iterator over the values whose keys are between the
+        minimum and maximum keys; see irange()"""
+        if minimum is None:
+            start = (0, 0)
+        elif inclusive[0]:
+            start = self.__locate_left(minimum)
+        else:
+            start = self.__locate_right(minimum)
+        if maximum is None:
+            stop = (len(self.__lists), 0)
+        elif inclusive[1]:
+            stop = self.__locate_right(maximum)
+        else:
+            stop = self.__locate_left(maximum)
+        return self.__slice(start, stop, reverse)
+
+    def islice(self, start=None, stop=None, reverse=False):
+        """Return an iterator over the values at positions start to stop
+
+        start and stop are interpreted as in a slice with a step of 1.
+
+        >>> seq = SortedList("hello")
+        >>> list(seq.islice(1, -1))
+        ['h', 'l', 'l']
+        >>> list(seq.islice(-2, reverse=True))
+        ['o', 'l']
+        """
+        start, stop, _ = slice(start, stop).indices(self.__len)
+        if start >= stop:
+            return iter(())
+        pos, index = self.__position(stop - 1)
+        return self.__slice(self.__position(start), (pos, index + 1),
+                            reverse)
+
+    def __slice(self, start, stop, reverse=False):
+        # Yield the values from start up to stop, both (sublist, offset)
+        (first, begin), (last, end) = start, stop
+        if last == len(self.__lists):
+            if not self.__lists:
+                return
+            last, end = last - 1, len(self.__lists[last - 1])
+        if (first, begin) >= (last, end):
+            return
+        positions = range(first, last + 1)
+        for pos in reversed(positions) if reverse else positions:
+            sublist = self.__lists[pos]
+            low = begin if pos == first else 0
+            high = end if pos == last else len(sublist)
+            if reverse:
+                yield from itertools.islice(reversed(sublist),
+                                            len(sublist) - high,
+                                            len(sublist) - low)
+            else:
+                yield from itertools.islice(sublist, low, high)
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.__len)
+            if step == 1:
+                self.__delete_range(start, stop)
+            else:
+                doomed = set(range(start, stop, step))
+                pairs = [pair for i, pair in enumerate(
+                    zip(self, self.__all_keys())) if i not in doomed]
+                self.__reset([value for value, _ in pairs],
+                             [key for _, key in pairs])
+        else:
+            self.__delete(*self.__position(index))
 
     def __getitem__(self, index):
-        return self.__list[index]
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.__len)
+            if step == 1:
+                return list(self.islice(start, stop))
+            return list(self)[index]
+        pos, offset = self.__position(index)
+        return self.__lists[pos][offset]
 
     def __setitem__(self, index, value):
         raise TypeError("use add() to insert a value and reply to"
                         "the list and put it in the right place")
 
     def __iter__(self):
-        return iter(self.__list)
+        return itertools.chain.from_iterable(self.__lists)
 
     def __reversed__(self):
-        return reversed(self.__list)
+        return itertools.chain.from_iterable(
+            map(reversed, reversed(self.__lists)))
 
     def __contains__(self, value):
-        index = self.__bisect_left(value)
-        return (index < len(self.__list) and
-                self.__list[index] == value)
+        return self.__find(value) is not None
 
     def clear(self):
-        self.__list = []
+        self.__reset([], [])
 
     def pop(self, index=-1):
-        return self.__list.pop(index)
+        if not self.__len:
+            raise IndexError("pop from empty {0}".format(
+                self.__class__.__name__
+            ))
+        return self.__delete(*self.__position(index))
 
     def __len__(self):
-        return len(self.__list)
+        return self.__len
 
     def __str__(self):
-        return str(self.__list)
+        return str(list(self))
 
     def copy(self):
-        return SortedList(self, self.__key)
+        return SortedList(self, self.__key, self.__load)
@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the ch06 classes.
+
+Run from the repository root, e.g.:
+
+    python -m ch06_objects.benchmark sortedlist_keys 10000 10000000
+"""
+import os
+import pickle
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from ch06_objects import Account
+from ch06_objects import Image
+from ch06_objects import Ledger
+from ch06_objects import Shape
+from ch06_objects import SortedDict
+from ch06_objects import SortedList
+
+
+class CountingKey:
+    """Key function wrapper that counts how often it is called"""
+
+    def __init__(self, key=str.lower):
+        self.key = key
+        self.calls = 0
+
+    def __call__(self, value):
+        self.calls += 1
+        return self.key(value)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def report(name, size, seconds, operations, extra=""):
+    print("{0:<28} n={1:<10,} {2:9.3f}s {3:>12,.0f} ops/s {4}".format(
+        name, size, seconds, operations / seconds if seconds else 0,
+        extra))
+
+
+def _uncached_bisect_left(values, value, key):
+    # The bisection SortedList used before keys were cached
+    target = key(value)
+    left, right = 0, len(values)
+    while left < right:
+        middle = (left + right) // 2
+        if key(values[middle]) < target:
+            left = middle + 1
+        else:
+            right = middle
+    return left
+
+
+def sortedlist_keys(sizes, probes=10000):
+    """Key calls and throughput of lookups and add() with an expensive key"""
+    for size in sizes:
+        words = ["Word{0:08d}".format(random.randrange(size * 10))
+                 for _ in range(size)]
+        extra = ["Extra{0:08d}".format(i) for i in range(probes)]
+
+        key = CountingKey()
+        values = sorted(words, key=key)
+        key.calls = 0
+        seconds, _ = timed(lambda: [_uncached_bisect_left(values, word, key)
+                                    for word in extra])
+        report("uncached bisect", size, seconds, probes,
+               "{0:.1f} key calls/op".format(key.calls / probes))
+
+        key = CountingKey()
+        seq = SortedList.SortedList(words, key)
+        key.calls = 0
+        seconds, _ = timed(lambda: [word in seq for word in extra])
+        report("SortedList.__contains__", size, seconds, probes,
+               "{0:.1f} key calls/op".format(key.calls / probes))
+
+        key.calls = 0
+        seconds, _ = timed(lambda: [seq.add(word) for word in extra])
+        report("SortedList.add", size, seconds, probes,
+               "{0:.1f} key calls/op".format(key.calls / probes))
+
+
+def sortedlist_chunked(sizes, operations=10000):
+    """add(), remove() and pop(0) in flat versus chunked storage"""
+    for size in sizes:
+        values = [random.random() for _ in range(size)]
+        extra = [random.random() for _ in range(operations)]
+        for name, load in (("flat", None),
+                           ("chunked", SortedList.DEFAULT_LOAD)):
+            seq = SortedList.SortedList(values, load=load)
+            seconds, _ = timed(lambda: [seq.add(x) for x in extra])
+            report(name + " add", size, seconds, operations)
+            seconds, _ = timed(lambda: [seq.remove(x) for x in extra])
+            report(name + " remove", size, seconds, operations)
+            pops = min(operations, len(seq))
+            seconds, _ = timed(lambda: [seq.pop(0) for _ in range(pops)])
+            report(name + " pop(0)", size, seconds, pops)
+
+
+def sortedlist_duplicates(sizes, distinct=100):
+    """count() and remove_every() with heavily duplicated values"""
+    for size in sizes:
+        seq = SortedList.SortedList(i % distinct for i in range(size))
+        seconds, _ = timed(lambda: [sum(1 for item in seq.irange(x, x)
+                                        if item == x)
+                                    for x in range(distinct)])
+        report("count by scanning", size, seconds, distinct)
+        seconds, _ = timed(lambda: [seq.count(x) for x in range(distinct)])
+        report("SortedList.count", size, seconds, distinct)
+        seconds, _ = timed(lambda: [seq.remove_every(x)
+                                    for x in range(distinct)])
+        report("SortedList.remove_every", size, seconds, distinct)
+
+
+def sorteddict_update(sizes, updates=10 ** 5, batch=10):
+    """Many small update() calls into a large SortedDict"""
+    for size in sizes:
+        d = SortedDict.SortedDict.fromkeys(range(0, 2 * size, 2), 0)
+        batches = [{random.randrange(4 * size): 1 for _ in range(batch)}
+                   for _ in range(updates)]
+        seconds, _ = timed(SortedList.SortedList, list(d.keys()))
+        report("rebuild keys per update", size, seconds, 1,
+               "(the old update() cost)")
+        seconds, _ = timed(lambda: [d.update(b) for b in batches])
+        report("SortedDict.update", size, seconds, updates)
+
+
+def snapshot_load(sizes):
+    """Unpickling a SortedDict snapshot versus rebuilding from a dict"""
+    for size in sizes:
+        keys = [random.random() for _ in range(size)]
+        d = SortedDict.SortedDict.fromkeys(keys, 0)
+        plain = pickle.dumps(dict(d), pickle.HIGHEST_PROTOCOL)
+        sorted_ = pickle.dumps(d, pickle.HIGHEST_PROTOCOL)
+        seconds, _ = timed(lambda: SortedDict.SortedDict(pickle.loads(plain)))
+        report("load dict and re-sort", size, seconds, 1)
+        seconds, _ = timed(pickle.loads, sorted_)
+        report("load sorted snapshot", size, seconds, 1)
+
+
+def image_fill(sizes):
+    """Filling a size x size rectangle pixel by pixel versus fill_rect()"""
+    for size in sizes:
+        for name, options in (("sparse", {"dense": False}),
+                              ("dense", {"dense": True}),
+                              ("tiled", {"tiled": True})):
+            image = Image.Image(size, size, **options)
+
+            def per_pixel():
+                for x in range(size):
+                    for y in range(size):
+                        image[x, y] = "#000000"
+
+            seconds, _ = timed(per_pixel)
+            report(name + " per-pixel fill", size, seconds, size * size)
+            seconds, _ = timed(image.fill_rect, 0, 0, size, size, "#FF0000")
+            report(name + " fill_rect", size, seconds, size * size)
+
+
+def _naive_disc(image, circle, color):
+    radius = circle.radius
+    for y in range(max(0, circle.y - radius),
+                   min(image.height, circle.y + radius + 1)):
+        for x in range(max(0, circle.x - radius),
+                       min(image.width, circle.x + radius + 1)):
+            if (x - circle.x) ** 2 + (y - circle.y) ** 2 <= radius ** 2:
+                image[x, y] = color
+
+
+def _naive_flood_fill(image, x, y, color):
+    target = image[x, y]
+    stack = [(x, y)]
+    while stack:
+        x, y = stack.pop()
+        if (0 <= x < image.width and 0 <= y < image.height and
+                image[x, y] == target):
+            image[x, y] = color
+            stack.extend(((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)))
+
+
+def image_draw(sizes):
+    """Filled circle and flood fill with per-pixel loops versus the
+    span-based drawing primitives"""
+    for size in sizes:
+        circle = Shape.Circle(size // 3, size // 2, size // 2)
+        for name, fill_disc, flood_fill in (
+                ("per-pixel", _naive_disc, _naive_flood_fill),
+                ("span", lambda image, circle, color:
+                    image.draw_circle(circle, color, fill=True),
+                 Image.Image.flood_fill)):
+            image = Image.Image(size, size, dense=True)
+            image.draw_line(0, 0, size - 1, size - 1, "#0000FF")
+            seconds, _ = timed(fill_disc, image, circle, "#FF0000")
+            report(name + " filled circle", size, seconds, 1)
+            seconds, _ = timed(flood_fill, image, 0, size - 1, "#00FF00")
+            report(name + " flood fill", size, seconds, 1)
+
+
+def image_access(sizes, accesses=10 ** 6):
+    """Per-access cost of checked versus unchecked pixel get/set"""
+    for size in sizes:
+        image = Image.Image(size, size, dense=True)
+        coordinates = [(random.randrange(size), random.randrange(size))
+                       for _ in range(accesses)]
+
+        def checked_get():
+            for coordinate in coordinates:
+                image[coordinate]
+
+        def unchecked_get():
+            get = image.get_unchecked
+            for x, y in coordinates:
+                get(x, y)
+
+        def checked_set():
+            for coordinate in coordinates:
+                image[coordinate] = "#000000"
+
+        def unchecked_set():
+            set_ = image.set_unchecked
+            for x, y in coordinates:
+                set_(x, y, "#000000")
+
+        for name, function in (("image[x, y]", checked_get),
+                               ("get_unchecked", unchecked_get),
+                               ("image[x, y] = color", checked_set),
+                               ("set_unchecked", unchecked_set)):
+            seconds, _ = timed(function)
+            report(name, size, seconds, accesses, "{0:.0f} ns/access".format(
+                seconds / accesses * 1e9))
+
+
+def _random_transactions(size, start=datetime(2019, 1, 1)):
+    rates = {"USD": 1.0, "EUR": 0.9, "RUB": 62.5}
+    for _ in range(size):
+        currency = random.choice(("USD", "USD", "EUR", "RUB"))
+        yield Account.Transaction(
+            random.randrange(1, 10 ** 5) / 100,
+            datetime.fromtimestamp(start.timestamp() +
+                                   random.randrange(365 * 24 * 3600)),
+            currency, rates[currency])
+
+
+def account_balance(sizes, reads=1000):
+    """Reading balance/all_usd by summing every transaction versus the
+    running totals kept by apply()"""
+    for size in sizes:
+        account = Account.Account(1, "benchmark")
+        transactions = list(_random_transactions(size))
+        seconds, _ = timed(lambda: [account.apply(t) for t in transactions])
+        report("Account.apply", size, seconds, size)
+        seconds, _ = timed(lambda: [sum(t.usd for t in transactions)
+                                    for _ in range(reads // 100)])
+        report("sum of t.usd", size, seconds, reads // 100)
+        seconds, _ = timed(lambda: [(account.balance, account.all_usd)
+                                    for _ in range(reads)])
+        report("Account.balance", size, seconds, reads)
+
+
+def account_journal(sizes, appends=100):
+    """Persisting each new transaction with save() versus a journal"""
+    filename = os.path.join(tempfile.gettempdir(), "benchmark.acc")
+    for size in sizes:
+        transactions = list(_random_transactions(size + appends))
+        for name in ("save per apply", "journal apply"):
+            account = Account.Account(1, "benchmark")
+            for t in transactions[:size]:
+                account.apply(t)
+            if name == "journal apply":
+                account.open_journal(filename)
+                function = account.apply
+            else:
+                account.save(filename)
+
+                def function(t):
+                    account.apply(t)
+                    account.save()
+            seconds, _ = timed(lambda: [function(t)
+                                        for t in transactions[size:]])
+            account.close_journal()
+            report(name, size, seconds, appends)
+        os.remove(filename)
+
+
+def account_dates(sizes, queries=1000):
+    """balance_at() and transactions_between() versus scanning every
+    transaction"""
+    for size in sizes:
+        account = Account.Account(1, "benchmark")
+        for t in sorted(_random_transactions(size), key=lambda t: t.date):
+            account.apply(t)
+        dates = [t.date for t in
+                 _random_transactions(queries, datetime(2019, 1, 15))]
+        transactions = account._transactions
+        seconds, _ = timed(lambda: [sum(t.usd for t in transactions
+                                        if t.date <= date)
+                                    for date in dates[:10]])
+        report("scan balance as of date", size, seconds, 10)
+        seconds, _ = timed(account.balance_at, dates[0])
+        report("build date index", size, seconds, 1)
+        seconds, _ = timed(lambda: [account.balance_at(date)
+                                    for date in dates])
+        report("Account.balance_at", size, seconds, queries)
+        seconds, _ = timed(lambda: [account.transactions_between(
+                                        date, date.replace(hour=23))
+                                    for date in dates])
+        report("Account.transactions_between", size, seconds, queries)
+
+
+class _DictTransaction:
+    """Transaction as it was before __slots__, keeping its attributes in
+    an instance dict; only what building one needs is copied"""
+
+    def __init__(self, amount, date, currency='USD', usd_conversion_rate=1.0,
+                 description=None):
+        if amount is None:
+            raise ValueError('amount could not be None')
+        if date is None:
+            raise ValueError('date could not be None')
+        if currency == 'USD' and not usd_conversion_rate == 1.0:
+            raise ValueError('USD conversion rate should be equal to 1.0')
+        self._amount = amount
+        self._date = date
+        self._currency = currency
+        self._usd_conversion_rate = usd_conversion_rate
+        self._description = description
+
+
+def _traced(function):
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+        return seconds, tracemalloc.get_traced_memory()[0], result
+    finally:
+        tracemalloc.stop()
+
+
+def transaction_memory(sizes):
+    """Memory held by dict-based Transactions, slotted Transactions and
+    a columnar TransactionBatch"""
+    for size in sizes:
+        rows = [(t.amount, t.date.timestamp(), t.currency,
+                 t.usd_conversion_rate)
+                for t in _random_transactions(size)]
+
+        def build(cls):
+            return [cls(amount, datetime.fromtimestamp(timestamp), currency,
+                        rate)
+                    for amount, timestamp, currency, rate in rows]
+
+        for name, function in (
+                ("dict Transactions", lambda: build(_DictTransaction)),
+                ("slotted Transactions",
+                 lambda: build(Account.Transaction)),
+                ("TransactionBatch", lambda: Account.TransactionBatch(
+                    Account.Transaction(amount,
+                                        datetime.fromtimestamp(timestamp),
+                                        currency, rate)
+                    for amount, timestamp, currency, rate in rows))):
+            seconds, memory, _ = _traced(function)
+            report(name, size, seconds, size, "{0:.1f} MB, {1:.0f} B/each"
+                   .format(memory / 2 ** 20, memory / size))
+
+
+def account_batch(sizes):
+    """apply() per transaction versus apply_many(), and aggregate() over
+    list versus columnar storage"""
+    for size in sizes:
+        transactions = sorted(_random_transactions(size),
+                              key=lambda t: t.date)
+        for columnar in (False, True):
+            name = "columnar " if columnar else "list "
+            account = Account.Account(1, "benchmark", columnar)
+            seconds, _ = timed(lambda: [account.apply(t)
+                                        for t in transactions])
+            report(name + "apply", size, seconds, size)
+            account = Account.Account(1, "benchmark", columnar)
+            seconds, _ = timed(account.apply_many, transactions)
+            report(name + "apply_many", size, seconds, size)
+            seconds, _ = timed(account.aggregate)
+            report(name + "aggregate", size, seconds, size)
+
+
+def ledger_load(sizes, transactions=100):
+    """Loading a directory of accounts one by one versus a Ledger"""
+    for size in sizes:
+        directory = tempfile.mkdtemp()
+        try:
+            ledger = Ledger.Ledger(directory)
+            for number in range(size):
+                account = Account.Account(number, "benchmark")
+                account.apply_many(_random_transactions(transactions))
+                ledger.add(account)
+            seconds, _ = timed(ledger.save)
+            report("Ledger.save", size, seconds, size)
+
+            def serial():
+                for filename in os.listdir(directory):
+                    Account.Account(0, "serial").load(
+                        os.path.join(directory, filename))
+
+            seconds, _ = timed(serial)
+            report("Account.load per file", size, seconds, size)
+            ledger = Ledger.Ledger(directory)
+            seconds, _ = timed(ledger.load)
+            report("Ledger.load", size, seconds, size)
+            ledger = Ledger.Ledger(directory)
+            seconds, _ = timed(ledger.load, False)
+            report("Ledger.load summaries", size, seconds, size)
+            seconds, _ = timed(lambda: (ledger.total_usd(), ledger.top(10),
+                                        ledger.non_usd()))
+            report("Ledger aggregate queries", size, seconds, 1)
+        finally:
+            shutil.rmtree(directory)
+
+
+def account_rates(sizes):
+    """Re-pricing an account at a RateTable's rates per transaction
+    versus balance_in()"""
+    rates = Account.RateTable()
+    for day in range(1, 29):
+        for currency, rate in (("EUR", 0.9), ("RUB", 62.5)):
+            rates.add(datetime(2019, 2, day).date(), currency,
+                      rate * (1 + day / 100))
+    as_of = datetime(2019, 12, 31)
+    for size in sizes:
+        account = Account.Account(1, "benchmark")
+        account.apply_many(_random_transactions(size))
+        seconds, _ = timed(lambda: sum(
+            t.amount / rates.rate(t.currency, as_of)
+            for t in account._transactions if t.date <= as_of))
+        report("per-transaction repricing", size, seconds, 1)
+        seconds, _ = timed(account.balance_in, "USD", None, rates)
+        report("balance_in", size, seconds, 1)
+        seconds, _ = timed(account.balance_at, as_of)
+        report("build date index", size, seconds, 1)
+        seconds, _ = timed(account.balance_in, "USD", as_of, rates)
+        report("balance_in as of date", size, seconds, 1)
+
+
+BENCHMARKS = {
+    "sortedlist_keys": sortedlist_keys,
+    "sortedlist_chunked": sortedlist_chunked,
+    "sortedlist_duplicates": sortedlist_duplicates,
+    "sorteddict_update": sorteddict_update,
+    "snapshot_load": snapshot_load,
+    "image_fill": image_fill,
+    "image_draw": image_draw,
+    "image_access": image_access,
+    "account_balance": account_balance,
+    "account_journal": account_journal,
+    "account_dates": account_dates,
+    "transaction_memory": transaction_memory,
+    "account_batch": account_batch,
+    "ledger_load": ledger_load,
+    "account_rates": account_rates,
+}
+
+# Image benchmarks take image side lengths rather than element counts
+IMAGE_SIZES = [1024, 4096]
+DEFAULT_SIZES = {"image_fill": IMAGE_SIZES, "image_draw": IMAGE_SIZES,
+                 "image_access": IMAGE_SIZES}
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print("usage: python -m ch06_objects.benchmark {{{0}}} [sizes...]"
+              .format("|".join(sorted(BENCHMARKS))))
+        sys.exit(1)
+    sizes = ([int(size) for size in sys.argv[2:]] or
+             DEFAULT_SIZES.get(sys.argv[1], [10 ** 4, 10 ** 5]))
+    BENCHMARKS[sys.argv[1]](sizes)
+
+
+if __name__ == "__main__":
+    main()